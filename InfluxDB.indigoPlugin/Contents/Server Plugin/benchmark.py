@@ -0,0 +1,129 @@
+import time as time_
+
+# average seconds per call of func(*args) over every entry in argsList,
+# taking the best of a few runs to keep other Indigo activity out of it
+def per_call(func, argsList, runs=5, repeat=10):
+	if not argsList:
+		return 0.0
+
+	best = None
+	for run in range(runs):
+		started = time_.time()
+		for i in range(repeat):
+			for args in argsList:
+				func(*args)
+		elapsed = time_.time() - started
+		if best is None or elapsed < best:
+			best = elapsed
+
+	return best / (repeat * len(argsList))
+
+def format_time(seconds):
+	if seconds < 0.001:
+		return u'%.1f us' % (seconds * 1000000)
+	return u'%.2f ms' % (seconds * 1000)
+
+# points/s of the influxdb client's encoding (what write_points does with
+# a list of dicts) against the plugin's own line protocol encoder
+def encoder_benchmark(points, runs=5):
+	import gzip
+	import StringIO
+	from influxdb.line_protocol import make_lines
+	from line_protocol import LineEncoder
+
+	# the client wants integer times already in the write precision
+	clientPoints = [dict(point, time=int(point['time'] * 1000)) for point in points]
+
+	encoder = LineEncoder()
+	client = per_call(lambda: make_lines({'points': clientPoints}, 'ms').encode('utf-8'), [()], runs, 1)
+	plugin = per_call(lambda: encoder.encode_batch(points, 'ms'), [()], runs, 1)
+
+	data = encoder.encode_batch(points, 'ms')
+	buf = StringIO.StringIO()
+	with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=5) as f:
+		f.write(data)
+
+	return {
+		'points': len(points),
+		'client': len(points) / max(client, 0.0000001),
+		'plugin': len(points) / max(plugin, 0.0000001),
+		'bytes': len(data),
+		'gzipped': len(buf.getvalue())
+	}
+
+def format_encoder_benchmark(result):
+	return u'%d points: influxdb client %d points/s, plugin encoder %d points/s (%.1fx), %d bytes, %d gzipped' % (
+		result['points'], result['client'], result['plugin'], result['plugin'] / max(result['client'], 1),
+		result['bytes'], result['gzipped'])
+
+# seconds per call of func(*args) with debug logging off and on.  With it
+# on, the given loggers write into a discarded stream, so the cost of
+# formatting is measured without flooding the Indigo log.  setDebug turns
+# the caller's debug switch on and off.
+def logging_benchmark(func, argsList, setDebug, loggerNames, runs=5):
+	import os
+	import logging
+
+	setDebug(False)
+	off = per_call(func, argsList, runs)
+
+	stream = open(os.devnull, 'w')
+	handler = logging.StreamHandler(stream)
+	loggers = [logging.getLogger(name) for name in loggerNames]
+	saved = [(logger.level, logger.propagate) for logger in loggers]
+	try:
+		for logger in loggers:
+			logger.addHandler(handler)
+			logger.propagate = False
+			logger.setLevel(logging.DEBUG)
+		setDebug(True)
+		on = per_call(func, argsList, runs)
+	finally:
+		setDebug(False)
+		for logger, (level, propagate) in zip(loggers, saved):
+			logger.removeHandler(handler)
+			logger.setLevel(level)
+			logger.propagate = propagate
+		stream.close()
+
+	return {'calls': len(argsList), 'off': off, 'on': on}
+
+def format_logging_benchmark(result):
+	return u'%s per call with debug off, %s with debug on (%.1fx)' % (
+		format_time(result['off']), format_time(result['on']), result['on'] / max(result['off'], 0.0000001))
+
+# what the diff loop does per device, for running outside of Indigo
+def sample_debug_loop(logger, switch, fields, name):
+	for key in fields:
+		if switch[0]:
+			logger.debug(u'Sending property: %s to InfluxDB for device: %s', key, name)
+
+# a batch that looks like a busy house, for running outside of Indigo
+def sample_points(devices=200, fields=8):
+	points = []
+	for i in range(devices):
+		for j in range(5):
+			point = {
+				'measurement': 'device_changes',
+				'tags': {'name': u'Device %d' % i, 'folderId': u'%d' % (i % 10), 'folder': u'Folder %d' % (i % 10)},
+				'fields': {'name': u'Device %d' % i, 'id': float(i)},
+				'time': 1500000000.0 + (i * 5 + j) * 0.25
+			}
+			for k in range(fields):
+				point['fields']['state.value%d.num' % k] = float(i * j + k) / 3
+			point['fields']['state.onOffState'] = bool(j % 2)
+			points.append(point)
+	return points
+
+if __name__ == '__main__':
+	import logging
+
+	print format_encoder_benchmark(encoder_benchmark(sample_points()))
+
+	switch = [False]
+	def setDebug(on):
+		switch[0] = on
+	fields = ['state.value%d.num' % k for k in range(20)]
+	print 'Debug logging: ' + format_logging_benchmark(logging_benchmark(sample_debug_loop,
+		[(logging.getLogger('Plugin.adaptor'), switch, fields, u'Device %d' % i) for i in range(50)],
+		setDebug, ['Plugin.adaptor']))
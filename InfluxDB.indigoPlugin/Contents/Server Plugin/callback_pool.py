@@ -0,0 +1,88 @@
+import threading
+import Queue
+import logging
+
+DEFAULT_CALLBACK_WORKERS = 2		# threads converting device and variable updates
+DEFAULT_CALLBACK_QUEUE_SIZE = 10000	# max number of updates waiting per thread
+
+class CallbackPool(object):
+	'''
+	Do the work behind the Indigo callbacks on a few worker threads, so the
+	callbacks return right away. Work for the same key (a device or variable
+	id) always goes to the same worker and runs in the order it came in, so
+	the points of one device are never reordered.
+	'''
+	def __init__(self, workers=DEFAULT_CALLBACK_WORKERS, queueSize=DEFAULT_CALLBACK_QUEUE_SIZE):
+		self.logger = logging.getLogger("Plugin.callbacks")
+		self.queues = [Queue.Queue(maxsize=max(1, int(queueSize))) for index in range(max(1, int(workers)))]
+		self.threads = []
+
+		self.lock = threading.Lock()
+		self.submitted = 0
+		self.completed = 0
+		self.dropped = 0
+		self.failed = 0
+
+	def __len__(self):
+		return len(self.queues)
+
+	def start(self):
+		for index, queue in enumerate(self.queues):
+			thread = threading.Thread(target=self.run, args=(queue,), name='InfluxCallback%d' % index)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	# finish what is queued, then stop the workers
+	def stop(self, timeout=10):
+		for queue in self.queues:
+			try:
+				queue.put(None, True, timeout)
+			except Queue.Full:
+				pass
+		for thread in self.threads:
+			thread.join(timeout)
+		self.threads = []
+
+	# never blocks the caller - if the worker is that far behind the update
+	# is dropped, and the next one for the key carries its changes
+	def submit(self, key, func, *args):
+		try:
+			self.queues[hash(key) % len(self.queues)].put_nowait((func, args))
+		except Queue.Full:
+			with self.lock:
+				self.dropped += 1
+			return False
+
+		with self.lock:
+			self.submitted += 1
+		return True
+
+	def run(self, queue):
+		while True:
+			work = queue.get()
+			if work is None:
+				return
+
+			func, args = work
+			try:
+				func(*args)
+			except Exception as e:
+				self.logger.error(u'Error in %s: %s' % (func.__name__, unicode(e)))
+				with self.lock:
+					self.failed += 1
+				continue
+
+			with self.lock:
+				self.completed += 1
+
+	def stats(self):
+		with self.lock:
+			return {
+				'workers': len(self.queues),
+				'submitted': self.submitted,
+				'completed': self.completed,
+				'dropped': self.dropped,
+				'failed': self.failed,
+				'depth': sum(queue.qsize() for queue in self.queues)
+			}
@@ -0,0 +1,119 @@
+import heapq
+import threading
+import logging
+import time as time_
+
+DEFAULT_COALESCE_WINDOW = 0	# milliseconds an update waits for more of the same device, 0 for none
+DEFAULT_COALESCE_KEEP = u'onOffState'	# fields whose first and last value in a window are both sent
+
+# the value of an Indigo state or attribute of a device
+def field_value(dev, name):
+	states = getattr(dev, 'states', None)
+	if states is not None and name in states:
+		return states[name]
+	return getattr(dev, name, None)
+
+class UpdateCoalescer(threading.Thread):
+	'''
+	Hold device updates for a short window, keyed by device id, and pass on
+	only the latest state of each device when the window closes. When one of
+	the keep fields has changed between the first and the last update of a
+	window, the first update is passed on as well, so transitions such as
+	off-on-off are not lost.
+	'''
+	def __init__(self, emit, window, keepFields=()):
+		super(UpdateCoalescer, self).__init__(name='InfluxCoalescer')
+		self.daemon = True
+		self.logger = logging.getLogger("Plugin.coalesce")
+
+		# called with (id, origDev, newDev, when) for each update to process
+		self.emit = emit
+		self.window = max(0.001, float(window))
+		self.keepFields = tuple(keepFields)
+
+		self.running = False
+		self.condition = threading.Condition()
+		# id -> [first origDev, first newDev, first when, last newDev, last when]
+		self.pending = {}
+		# (deadline, id)
+		self.deadlines = []
+
+		self.events = 0
+		self.coalesced = 0
+		self.emitted = 0
+
+	def add(self, id, origDev, newDev, when):
+		with self.condition:
+			self.events += 1
+			entry = self.pending.get(id)
+			if entry is not None:
+				entry[3] = newDev
+				entry[4] = when
+				self.coalesced += 1
+				return
+
+			self.pending[id] = [origDev, newDev, when, newDev, when]
+			heapq.heappush(self.deadlines, (time_.time() + self.window, id))
+			self.condition.notify()
+
+	# forget a device's pending update, e.g. once it is deleted
+	def discard(self, id):
+		with self.condition:
+			self.pending.pop(id, None)
+
+	def start(self):
+		self.running = True
+		super(UpdateCoalescer, self).start()
+
+	# pass on everything still pending, then stop
+	def stop(self, timeout=10):
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		if self.is_alive():
+			self.join(timeout)
+
+	def run(self):
+		while True:
+			with self.condition:
+				while self.running and (not self.deadlines or self.deadlines[0][0] > time_.time()):
+					self.condition.wait(self.deadlines[0][0] - time_.time() if self.deadlines else None)
+
+				now = time_.time()
+				due = []
+				while self.deadlines and (not self.running or self.deadlines[0][0] <= now):
+					deadline, id = heapq.heappop(self.deadlines)
+					entry = self.pending.pop(id, None)
+					if entry is not None:
+						due.append((id, entry))
+				running = self.running
+
+			for id, entry in due:
+				try:
+					self.release(id, *entry)
+				except Exception as e:
+					self.logger.error(u'Error while passing on an update: %s' % unicode(e))
+
+			if not running:
+				return
+
+	def release(self, id, origDev, firstDev, firstWhen, lastDev, lastWhen):
+		if firstDev is not lastDev:
+			for name in self.keepFields:
+				if field_value(firstDev, name) != field_value(lastDev, name):
+					self.emitted += 1
+					self.emit(id, origDev, firstDev, firstWhen)
+					origDev = firstDev
+					break
+
+		self.emitted += 1
+		self.emit(id, origDev, lastDev, lastWhen)
+
+	def stats(self):
+		with self.condition:
+			return {
+				'events': self.events,
+				'coalesced': self.coalesced,
+				'emitted': self.emitted,
+				'pending': len(self.pending)
+			}
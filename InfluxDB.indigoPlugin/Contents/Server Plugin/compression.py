@@ -0,0 +1,215 @@
+import sys
+import fnmatch
+import logging
+import threading
+
+class SwingingDoor(object):
+	'''
+	Swinging door trending for one numeric series. Samples are held back
+	until a later sample shows they are needed to draw the series as
+	straight lines that stay within deviation of every sample.
+	'''
+	__slots__ = ('deviation', 'archived', 'held', 'lower', 'upper')
+
+	def __init__(self, deviation):
+		self.deviation = deviation
+		# last sample written
+		self.archived = None
+		# latest sample, the end of the current line
+		self.held = None
+		# slopes from the archived sample that keep every sample since
+		# within the deviation
+		self.lower = None
+		self.upper = None
+
+	# add a sample; returns the samples to write now
+	def add(self, t, v):
+		if self.archived is None:
+			self.archived = (t, v)
+			return [(t, v)]
+
+		t0, v0 = self.archived
+		if t <= t0 or (self.held is not None and t <= self.held[0]):
+			return []
+
+		if self.held is not None:
+			slope = (v - v0) / (t - t0)
+			if not self.lower <= slope <= self.upper:
+				# the door closed: the held sample ends the line
+				out = self.held
+				self.archived = out
+				self.held = None
+				t0, v0 = out
+				self._open(t, v, t0, v0)
+				return [out]
+
+			self.lower = max(self.lower, (v - self.deviation - v0) / (t - t0))
+			self.upper = min(self.upper, (v + self.deviation - v0) / (t - t0))
+			self.held = (t, v)
+			return []
+
+		self._open(t, v, t0, v0)
+		return []
+
+	def _open(self, t, v, t0, v0):
+		self.lower = (v - self.deviation - v0) / (t - t0)
+		self.upper = (v + self.deviation - v0) / (t - t0)
+		self.held = (t, v)
+
+	# write whatever is held back, e.g. before a heartbeat
+	def flush(self):
+		if self.held is None:
+			return None
+
+		out = self.archived = self.held
+		self.held = None
+		return out
+
+# "field=deviation" items separated by commas, e.g.
+# "state.temperature.num=0.2, energy*.num=0.01".  Only .num fields are
+# compressed; the first matching rule wins.
+def parse_rules(text):
+	logger = logging.getLogger("Plugin.compression")
+	rules = []
+	for item in (text or "").replace(" ", "").split(","):
+		if not item:
+			continue
+		try:
+			field, deviation = item.split("=", 1)
+			rules.append((field, float(deviation)))
+		except ValueError:
+			logger.warning(u'Ignoring compression rule "%s", expected field=deviation' % item)
+	return rules
+
+class SeriesCompressor(object):
+	'''
+	A swinging door per device and numeric field
+	'''
+	def __init__(self, rules):
+		self.rules = rules
+		self.lock = threading.Lock()
+		# field -> deviation, or None when the field is not compressed
+		self.matches = {}
+		# device id -> field -> SwingingDoor
+		self.series = {}
+		self.samples = 0
+		self.written = 0
+
+	def __nonzero__(self):
+		return len(self.rules) > 0
+
+	def deviation(self, field):
+		try:
+			return self.matches[field]
+		except KeyError:
+			deviation = None
+			if field.endswith('.num'):
+				for pattern, candidate in self.rules:
+					if fnmatch.fnmatchcase(field, pattern):
+						deviation = candidate
+						break
+			self.matches[field] = deviation
+			return deviation
+
+	# pass the compressed fields of a point through their doors.  Returns
+	# the fields to write now, and (time, fields) for held back samples
+	# that have to be written at their own time.
+	def apply(self, id, fields, when):
+		earlier = {}
+		with self.lock:
+			doors = self.series.get(id)
+			for field, value in fields.items():
+				deviation = self.deviation(field)
+				if deviation is None or not isinstance(value, float):
+					continue
+
+				if doors is None:
+					doors = self.series[id] = {}
+				door = doors.get(field)
+				if door is None:
+					door = doors[field] = SwingingDoor(deviation)
+
+				self.samples += 1
+				del fields[field]
+				for t, v in door.add(when, value):
+					self.written += 1
+					if t == when:
+						fields[field] = v
+					else:
+						earlier.setdefault(t, {})[field] = v
+
+		return fields, sorted(earlier.iteritems())
+
+	# (time, fields) for everything a device holds back
+	def flush(self, id):
+		held = {}
+		with self.lock:
+			for field, door in self.series.get(id, {}).iteritems():
+				sample = door.flush()
+				if sample is not None:
+					self.written += 1
+					held.setdefault(sample[0], {})[field] = sample[1]
+		return sorted(held.iteritems())
+
+	def forget(self, id):
+		with self.lock:
+			self.series.pop(id, None)
+
+	# ids of the devices that have doors
+	def devices(self):
+		with self.lock:
+			return self.series.keys()
+
+# compress a recorded trace of (time, value) pairs and report how well it
+# went: the share of samples kept and the worst error when the kept
+# samples are joined by straight lines
+def replay(trace, deviation):
+	door = SwingingDoor(deviation)
+	kept = []
+	for t, v in trace:
+		kept.extend(door.add(t, v))
+	last = door.flush()
+	if last is not None:
+		kept.append(last)
+
+	maxError = 0.0
+	segment = 0
+	for t, v in trace:
+		while segment < len(kept) - 2 and kept[segment + 1][0] < t:
+			segment += 1
+		(ta, va), (tb, vb) = kept[segment], kept[min(segment + 1, len(kept) - 1)]
+		estimate = va if tb == ta else va + (vb - va) * (t - ta) / (tb - ta)
+		maxError = max(maxError, abs(estimate - v))
+
+	return {
+		'samples': len(trace),
+		'kept': len(kept),
+		'ratio': float(len(trace)) / max(len(kept), 1),
+		'maxError': maxError
+	}
+
+def read_trace(filename):
+	trace = []
+	with open(filename) as f:
+		for line in f:
+			parts = line.strip().split(',')
+			try:
+				trace.append((float(parts[0]), float(parts[1])))
+			except (IndexError, ValueError):
+				# headers and blank lines
+				continue
+	trace.sort()
+	return trace
+
+# python compression.py deviation trace.csv [trace.csv ...]
+# where each trace has time,value lines, e.g. exported from InfluxDB
+if __name__ == '__main__':
+	if len(sys.argv) < 3:
+		print 'usage: compression.py deviation trace.csv [trace.csv ...]'
+		sys.exit(1)
+
+	deviation = float(sys.argv[1])
+	for filename in sys.argv[2:]:
+		result = replay(read_trace(filename), deviation)
+		print '%s: %d samples, %d kept, %.1fx smaller, max error %g (deviation %g)' % (
+			filename, result['samples'], result['kept'], result['ratio'], result['maxError'], deviation)
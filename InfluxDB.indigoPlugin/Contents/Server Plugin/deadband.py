@@ -0,0 +1,142 @@
+import fnmatch
+import logging
+import threading
+
+class DeadbandRule(object):
+	'''
+	How much a field has to move, and how long after its last write, before
+	it is written again
+	'''
+	__slots__ = ('absolute', 'percent', 'interval')
+
+	def __init__(self, absolute=None, percent=None, interval=None):
+		self.absolute = absolute
+		self.percent = percent
+		self.interval = interval
+
+# "field=threshold[%][@seconds]" items separated by commas, for example
+# "state.temperature.num=0.5, energyCurLevel=5%, *.rssi.num=2@60, sensorValue=@30".
+# Field names may use * and ? wildcards; the first matching rule wins.
+def parse_rules(text):
+	logger = logging.getLogger("Plugin.deadband")
+	rules = []
+	for item in (text or "").replace(" ", "").split(","):
+		if not item:
+			continue
+		try:
+			field, spec = item.split("=", 1)
+			interval = None
+			if "@" in spec:
+				spec, interval = spec.split("@", 1)
+				interval = float(interval)
+
+			absolute = percent = None
+			if spec.endswith("%"):
+				percent = float(spec[:-1])
+			elif spec:
+				absolute = float(spec)
+
+			rules.append((field, DeadbandRule(absolute, percent, interval)))
+		except ValueError:
+			logger.warning(u'Ignoring deadband rule "%s", expected field=threshold[%%][@seconds]' % item)
+	return rules
+
+def _number(value):
+	return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+class Deadband(object):
+	'''
+	Drop field changes too small, or too soon after the last write, to be
+	worth sending. A change held back only by an interval is pending until
+	the interval has passed, so it can be sent then.
+	'''
+	def __init__(self, rules):
+		self.rules = rules
+		# field -> rule, or None when no rule applies
+		self.matches = {}
+		self.lock = threading.Lock()
+		# device id -> field -> when it was last written
+		self.lastSent = {}
+		# device id -> field -> when its held back change may be written
+		self.pending = {}
+		self.suppressed = 0
+
+	def __nonzero__(self):
+		return len(self.rules) > 0
+
+	def rule(self, field):
+		try:
+			return self.matches[field]
+		except KeyError:
+			rule = None
+			for pattern, candidate in self.rules:
+				if fnmatch.fnmatchcase(field, pattern):
+					rule = candidate
+					break
+			self.matches[field] = rule
+			return rule
+
+	# should a change of field from old to new at now be held back
+	def suppress(self, id, field, old, new, now):
+		rule = self.rule(field)
+		if rule is None:
+			return False
+
+		if _number(old) and _number(new):
+			change = abs(new - old)
+			if rule.absolute is not None and change < rule.absolute:
+				self.suppressed += 1
+				return True
+			if rule.percent is not None and change < abs(old) * rule.percent / 100.0:
+				self.suppressed += 1
+				return True
+
+		if rule.interval is not None:
+			last = self.lastSent.get(id, {}).get(field)
+			if last is not None and now - last < rule.interval:
+				self.suppressed += 1
+				with self.lock:
+					self.pending.setdefault(id, {})[field] = last + rule.interval
+				return True
+
+		return False
+
+	# whether the device has a change held back by an interval
+	def held(self, id):
+		return id in self.pending
+
+	# ids of devices with a held back change whose interval has passed; they
+	# are no longer pending, sending them again records what is still held
+	def due(self, now):
+		ids = []
+		with self.lock:
+			for id, fields in self.pending.items():
+				if min(fields.itervalues()) <= now:
+					ids.append(id)
+					del self.pending[id]
+		return ids
+
+	# remember when fields were written, for the interval rules
+	def sent(self, id, fields, now):
+		pending = self.pending.get(id)
+		if pending is not None:
+			with self.lock:
+				for field in fields:
+					pending.pop(field, None)
+				if not pending:
+					self.pending.pop(id, None)
+
+		times = None
+		for field in fields:
+			rule = self.rule(field)
+			if rule is None or rule.interval is None:
+				continue
+			if times is None:
+				with self.lock:
+					times = self.lastSent.setdefault(id, {})
+			times[field] = now
+
+	def forget(self, id):
+		with self.lock:
+			self.lastSent.pop(id, None)
+			self.pending.pop(id, None)
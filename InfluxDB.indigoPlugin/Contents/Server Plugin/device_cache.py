@@ -0,0 +1,122 @@
+import sys
+import threading
+
+_MISSING = object()
+
+class CachedDevice(object):
+	'''
+	The last values sent for one device. Field names live in a layout shared
+	by every device with the same fields; the device only keeps its values.
+	'''
+	__slots__ = ('name', 'layout', 'values')
+
+	def __init__(self, name, layout):
+		self.name = name
+		self.layout = layout
+		self.values = [_MISSING] * len(layout[1])
+
+	def get(self, key, default=None):
+		slot = self.layout[0].get(key)
+		if slot is None:
+			return default
+		value = self.values[slot]
+		return default if value is _MISSING else value
+
+	def __contains__(self, key):
+		return self.get(key, _MISSING) is not _MISSING
+
+	def iteritems(self):
+		for key, value in zip(self.layout[1], self.values):
+			if value is not _MISSING:
+				yield key, value
+
+	def __len__(self):
+		return sum(1 for value in self.values if value is not _MISSING)
+
+class DeviceCache(object):
+	'''
+	Last sent values of every device, keyed by device id
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.devices = {}
+		# field names tuple -> (field name -> slot, field names tuple)
+		self.layouts = {}
+
+	def get(self, id):
+		return self.devices.get(id)
+
+	def __contains__(self, id):
+		return id in self.devices
+
+	def __len__(self):
+		return len(self.devices)
+
+	def layout(self, keys):
+		layout = self.layouts.get(keys)
+		if layout is None:
+			layout = self.layouts[keys] = (dict((key, slot) for slot, key in enumerate(keys)), keys)
+		return layout
+
+	def update(self, id, name, fields):
+		with self.lock:
+			entry = self.devices.get(id)
+			if entry is None:
+				entry = self.devices[id] = CachedDevice(name, self.layout(tuple(sorted(fields))))
+			entry.name = name
+
+			slots = entry.layout[0]
+			extra = [key for key in fields if key not in slots]
+			if extra:
+				# move to the layout that has the new fields as well
+				keys = entry.layout[1]
+				old = dict(zip(keys, entry.values))
+				entry.layout = self.layout(tuple(sorted(keys + tuple(extra))))
+				entry.values = [old.get(key, _MISSING) for key in entry.layout[1]]
+				slots = entry.layout[0]
+
+			values = entry.values
+			for key, value in fields.iteritems():
+				values[slots[key]] = value
+			return entry
+
+	def forget(self, id):
+		with self.lock:
+			self.devices.pop(id, None)
+			self._prune()
+
+	def clear(self):
+		with self.lock:
+			self.devices.clear()
+			self.layouts.clear()
+
+	# rough memory use in bytes and counts, for the stats menu
+	def stats(self):
+		with self.lock:
+			size = sys.getsizeof(self.devices) + sys.getsizeof(self.layouts)
+			fields = 0
+			for entry in self.devices.itervalues():
+				size += sys.getsizeof(entry) + sys.getsizeof(entry.values)
+				for value in entry.values:
+					if value is not _MISSING:
+						size += sys.getsizeof(value)
+						fields += 1
+
+			self._prune()
+			for slots, keys in self.layouts.itervalues():
+				size += sys.getsizeof(slots) + sys.getsizeof(keys)
+				size += sum(sys.getsizeof(key) for key in keys)
+
+			return {
+				'devices': len(self.devices),
+				'fields': fields,
+				'layouts': len(self.layouts),
+				'bytes': size
+			}
+
+	# drop layouts no device uses any more
+	def _prune(self):
+		used = set(entry.layout[1] for entry in self.devices.itervalues())
+		for keys in self.layouts.keys():
+			if keys not in used:
+				del self.layouts[keys]
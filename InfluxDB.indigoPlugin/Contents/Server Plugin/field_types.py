@@ -0,0 +1,160 @@
+import os
+import json
+import threading
+import logging
+
+def to_float(value):
+	return float(value)
+
+def to_int(value):
+	number = float(value)
+	if number != int(number):
+		raise ValueError('%s is not a whole number' % value)
+	return int(number)
+
+def to_str(value):
+	return unicode(value)
+
+def to_bool(value):
+	if isinstance(value, basestring):
+		if value.lower() in (u'true', u't', u'1', u'on', u'yes'):
+			return True
+		if value.lower() in (u'false', u'f', u'0', u'off', u'no'):
+			return False
+		raise ValueError('%s is not a boolean' % value)
+	return bool(value)
+
+# InfluxDB field type -> converter
+CONVERTERS = {
+	'float': to_float,
+	'integer': to_int,
+	'string': to_str,
+	'boolean': to_bool
+}
+
+class FieldTypeRegistry(object):
+	'''
+	Remember the type InfluxDB holds for each field of each measurement and
+	coerce points to it before they are written
+	'''
+	def __init__(self, path=None):
+		self.logger = logging.getLogger("Plugin.fieldtypes")
+		self.path = path
+		self.lock = threading.Lock()
+		# measurement -> field -> influx type
+		self.types = {}
+		# measurement -> field -> converter
+		self.converters = {}
+		# (measurement, field) -> name of the InfluxDB target that set the type
+		self.owners = {}
+		self.changed = False
+
+	def set(self, measurement, field, influxType, owner=None):
+		converter = CONVERTERS.get(influxType)
+		if converter is None:
+			return
+
+		with self.lock:
+			if owner is not None:
+				self.owners[(measurement, field)] = owner
+			types = self.types.setdefault(measurement, {})
+			if types.get(field) == influxType:
+				return
+			types[field] = influxType
+			self.converters.setdefault(measurement, {})[field] = converter
+			self.changed = True
+
+	def remove(self, measurement, field):
+		with self.lock:
+			if self.types.get(measurement, {}).pop(field, None) is not None:
+				del self.converters[measurement][field]
+				self.changed = True
+			self.owners.pop((measurement, field), None)
+
+	def clear(self):
+		with self.lock:
+			self.types = {}
+			self.converters = {}
+			self.owners = {}
+			self.changed = True
+
+	def get(self, measurement, field):
+		return self.types.get(measurement, {}).get(field)
+
+	def owner(self, measurement, field):
+		return self.owners.get((measurement, field))
+
+	# whether any of the fields has a registered type
+	def covers(self, measurement, fields):
+		converters = self.converters.get(measurement)
+		if not converters:
+			return False
+		for field in fields:
+			if field in converters:
+				return True
+		return False
+
+	# read the field types the database already has, handing each to set
+	# (this registry's own by default)
+	def seed(self, connection, set=None):
+		if set is None:
+			set = self.set
+
+		count = 0
+		for (measurement, tags), fields in connection.query('SHOW FIELD KEYS').items():
+			for field in fields:
+				set(measurement, field['fieldKey'], field['fieldType'])
+				count += 1
+		return count
+
+	# coerce the fields of a point to the registered types in one pass.
+	# returns the names of fields that would not convert.
+	def coerce(self, measurement, fields):
+		converters = self.converters.get(measurement)
+		if not converters:
+			return []
+
+		failed = []
+		for field, value in fields.iteritems():
+			converter = converters.get(field)
+			if converter is None:
+				continue
+			try:
+				fields[field] = converter(value)
+			except (ValueError, TypeError):
+				failed.append(field)
+		return failed
+
+	def load(self):
+		if self.path is None or not os.path.exists(self.path):
+			return
+
+		try:
+			with open(self.path, 'rb') as f:
+				types = json.load(f)
+		except (IOError, ValueError) as e:
+			self.logger.warning(u'Unable to read the saved field types: %s' % unicode(e))
+			return
+
+		for measurement, fields in types.iteritems():
+			for field, influxType in fields.iteritems():
+				self.set(measurement, field, influxType)
+		self.changed = False
+
+	def save(self):
+		if self.path is None or not self.changed:
+			return
+
+		with self.lock:
+			data = json.dumps(self.types)
+			self.changed = False
+
+		try:
+			with open(self.path + '.tmp', 'wb') as f:
+				f.write(data)
+			os.rename(self.path + '.tmp', self.path)
+		except (IOError, OSError) as e:
+			self.logger.warning(u'Unable to save the field types: %s' % unicode(e))
+
+	def __len__(self):
+		return sum(len(fields) for fields in self.types.itervalues())
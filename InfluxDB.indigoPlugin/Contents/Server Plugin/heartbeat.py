@@ -0,0 +1,69 @@
+import heapq
+import random
+import threading
+import time as time_
+
+DEFAULT_PULSE_RATE = 20	# max heartbeat points per second
+
+class HeartbeatScheduler(object):
+	'''
+	Track when each device or variable was last sent, keyed by id, in a heap
+	ordered by when its minimum update frequency runs out. Entries that are
+	touched again are left in the heap and skipped when they surface.
+	'''
+	def __init__(self, interval):
+		self.interval = interval
+		self.lock = threading.Lock()
+		# (due, key) pairs, possibly stale
+		self.heap = []
+		# key -> current due time
+		self.due = {}
+
+	# the key was just sent (or last changed at the given time).  Keys that
+	# would already be overdue are spread over the coming interval instead
+	# of all coming due at once.
+	def touch(self, key, when=None):
+		now = time_.time()
+		if when is None:
+			when = now
+		due = when + self.interval
+		if due < now:
+			due = now + random.uniform(0, self.interval)
+
+		with self.lock:
+			self.due[key] = due
+			heapq.heappush(self.heap, (due, key))
+
+			# don't let superseded entries pile up
+			if len(self.heap) > 4 * len(self.due) + 64:
+				self.heap = [(due, key) for key, due in self.due.iteritems()]
+				heapq.heapify(self.heap)
+
+	def remove(self, key):
+		with self.lock:
+			self.due.pop(key, None)
+
+	def __contains__(self, key):
+		return key in self.due
+
+	def __len__(self):
+		return len(self.due)
+
+	# keys whose minimum update frequency has run out, at most limit of them;
+	# they are scheduled again a full interval from now
+	def expired(self, now=None, limit=None):
+		if now is None:
+			now = time_.time()
+
+		keys = []
+		with self.lock:
+			while self.heap and self.heap[0][0] <= now and (limit is None or len(keys) < limit):
+				due, key = heapq.heappop(self.heap)
+				if self.due.get(key) != due:
+					continue
+				keys.append(key)
+
+			for key in keys:
+				self.due[key] = now + self.interval
+				heapq.heappush(self.heap, (now + self.interval, key))
+		return keys
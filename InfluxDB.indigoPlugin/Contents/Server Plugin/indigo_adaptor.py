@@ -3,6 +3,10 @@ import time as time_
 import json
 import indigo
 from enum import Enum
+from device_cache import DeviceCache
+import plugin_log
+
+MISSING = object()
 
 # explicit changes
 def indigo_json_serial(obj):
@@ -23,7 +27,9 @@ class IndigoAdaptor():
 	Change indigo objects to flat dicts for simpler databases
 	'''
 	def __init__(self):
+		# set from the plugin's debug settings, see plugin_log.configure
 		self.debug = False
+		self.logger = plugin_log.getLogger("adaptor")
 		# Class Properties on http://wiki.indigodomo.com/doku.php?id=indigo_7_documentation:device_class
 		self.stringonly = 'displayStateValRaw displayStateValUi displayStateImageSel protocol'.split()
 
@@ -31,9 +37,27 @@ class IndigoAdaptor():
 		json.JSONEncoder.default = indigo_json_serial
 
 		# remember previous states for diffing, smaller databases
-		self.cache = {}
-		# remember column name/type mappings to reduce exceptions
-		self.typecache = {}
+		self.cache = DeviceCache()
+		# compiled attribute lists per device class and include/exclude list,
+		# see extraction_plan and filtered_plan
+		self.plans = {}
+		# include/exclude list -> state name -> (field name, numeric field name)
+		self.statekeys = {}
+		# value class -> kind of conversion smart_values applies
+		self.kinds = {}
+		# times extract and diff when set, see metrics.Metrics
+		self.metrics = None
+
+	# a device was deleted or its include/exclude list changed
+	def forget(self, id):
+		self.cache.forget(id)
+
+	# forget everything derived from devices or configuration
+	def invalidate(self):
+		self.plans.clear()
+		self.statekeys.clear()
+		# what was sent may no longer match what is wanted
+		self.cache.clear()
 
 	# returns None or a value, trying to convert strings to floats where
 	# possible
@@ -80,115 +104,250 @@ class IndigoAdaptor():
 				pass
 		return value
 
-	def to_json(self, device):
-		attrlist = [attr for attr in dir(device) if
-					attr[:2] + attr[-2:] != '____' and not callable(getattr(device, attr))]
-		#indigo.server.log(device.name + ' ' + ' '.join(attrlist))
-		newjson = {}
-		newjson[u'name'] = unicode(device.name)
-		for key in attrlist:
-			#import pdb; pdb.set_trace()
-			if hasattr(device, key) \
-				and key not in newjson.keys():
-				val = self.smart_value(getattr(device, key), False);
-				# some things change types - define the original name as original type, key.num as numeric
-				if val != None:
-					newjson[key] = val
-				if key in self.stringonly:
+	# which branch of smart_value a class of values takes, worked out once
+	def value_kind(self, cls):
+		kind = self.kinds.get(cls)
+		if kind is None:
+			if issubclass(cls, (indigo.List, list, indigo.Dict, dict)):
+				kind = 'skip'
+			elif issubclass(cls, bool):
+				kind = 'bool'
+			elif issubclass(cls, float):
+				kind = 'float'
+			elif issubclass(cls, int):
+				kind = 'int'
+			elif issubclass(cls, (datetime, date)):
+				kind = 'date'
+			elif issubclass(cls, basestring):
+				kind = 'string'
+			elif cls.__bases__ and cls.__bases__[0].__name__ == 'enum':
+				kind = 'enum'
+			else:
+				kind = 'other'
+			self.kinds[cls] = kind
+		return kind
+
+	# same as (smart_value(invalue), smart_value(invalue, True)) in one pass
+	def smart_values(self, invalue):
+		kind = self.value_kind(invalue.__class__)
+		if kind == 'skip':
+			return None, None
+
+		text = unicode(invalue)
+		if text == u"null" or text == u"None":
+			return None, None
+
+		if kind == 'bool':
+			return invalue, float(invalue)
+		elif kind == 'int':
+			return float(invalue), float(invalue)
+		elif kind == 'float':
+			return invalue, None
+		elif kind == 'date':
+			return time_.mktime(invalue.timetuple()), None
+		elif kind == 'string':
+			try:
+				return invalue, float(invalue)
+			except ValueError:
+				return invalue, None
+		elif kind == 'enum':
+			return text, invalue
+		return invalue, invalue
+
+	# the attributes worth reading for this kind of device, worked out once
+	# per device class and type rather than on every update
+	def extraction_plan(self, device):
+		plankey = (device.__class__, getattr(device, 'deviceTypeId', None))
+		plan = self.plans.get(plankey)
+		if plan is None:
+			plan = []
+			for attr in dir(device):
+				# name is always added first, dicts end enums will not upload
+				# without a little abuse
+				if attr[:2] + attr[-2:] == '____' \
+					or attr in ('name', 'states', 'globalProps', 'pluginProps', 'ownerProps'):
 					continue
-				val = self.smart_value(getattr(device, key), True);
-				if val is not None:
-					newjson[key + '.num'] = val
-
-		# trouble areas
-		# dicts end enums will not upload without a little abuse
-		for key in 'states globalProps pluginProps ' \
-			'ownerProps'.split():
-			if key in newjson.keys():
-				del newjson[key]
-
-		for key in newjson.keys():
-			if newjson[key].__class__.__name__.startswith('k'):
-				newjson[key] = unicode(newjson[key])
-
-		for key in self.stringonly:
-			if key in newjson.keys():
-				newjson[key] = unicode(newjson[key])
-
-		for state in device.states:
-			val = self.smart_value(device.states[state], False);
-			if val != None:
-				newjson[unicode('state.' + state)] = val
-			if state in self.stringonly:
-				continue
-			val = self.smart_value(device.states[state], True);
-			if val != None:
-				newjson[unicode('state.' + state + '.num')] = val
+				try:
+					if callable(getattr(device, attr)):
+						continue
+				except AttributeError:
+					continue
+				if attr in self.stringonly:
+					plan.append((attr, attr, None, True))
+				else:
+					plan.append((attr, attr, attr + '.num', False))
+			self.plans[plankey] = plan
+		return plankey, plan
+
+	# is this field sent under the given include/exclude list
+	def wanted(self, key, mode, names):
+		if mode == "include":
+			return key in names
+		return key not in names
+
+	# the extraction plan with the include/exclude list applied up front, so
+	# that filtered attributes are never read or converted
+	def filtered_plan(self, device, mode, names):
+		plankey, plan = self.extraction_plan(device)
+		if mode == "exclude" and not names:
+			return plan
+
+		filterkey = (plankey, mode, names)
+		filtered = self.plans.get(filterkey)
+		if filtered is None:
+			filtered = []
+			for attr, key, numkey, stringonly in plan:
+				if not self.wanted(key, mode, names):
+					key = None
+				if numkey is not None and not self.wanted(numkey, mode, names):
+					numkey = None
+				if key is not None or numkey is not None:
+					filtered.append((attr, key, numkey, stringonly))
+			self.plans[filterkey] = filtered
+		return filtered
+
+	# state name -> (field name, numeric field name), None where filtered
+	def state_keys(self, mode, names):
+		filterkey = (mode, names)
+		statekeys = self.statekeys.get(filterkey)
+		if statekeys is None:
+			statekeys = self.statekeys[filterkey] = {}
+		return statekeys
 
-		# Try to tell the caller what kind of measurement this is
-		if u'setpointHeat' in device.states.keys():
-			newjson[u'measurement'] = u'thermostat_changes'
+	# (field name, numeric field name) of a state, None where filtered
+	def state_fields(self, state, mode, names):
+		statekeys = self.state_keys(mode, names)
+		keys = statekeys.get(state)
+		if keys is None:
+			key = unicode('state.' + state)
+			numkey = None if state in self.stringonly else unicode('state.' + state + '.num')
+			keys = statekeys[state] = (
+				key if self.wanted(key, mode, names) else None,
+				numkey if numkey is not None and self.wanted(numkey, mode, names) else None)
+		return keys
+
+	# Try to tell the caller what kind of measurement this is
+	def measurement(self, device):
+		if u'setpointHeat' in device.states:
+			return u'thermostat_changes'
 		elif device.model == u'Weather Station':
-			newjson[u'measurement'] = u'weather_changes'
-		else:
-			newjson[u'measurement'] = u'device_changes'
+			return u'weather_changes'
+		return u'device_changes'
 
-		# try to honor previous complaints about column types
-		for key in self.typecache.keys():
-			if key in newjson.keys():
-				try:
-					newjson[key] = eval( '%s("%s")' % (self.typecache[key], str(newjson[key])))
-				except ValueError:
-					if self.debug:
-						indigo.server.log('One of the columns just will not convert to the requested type. Partial record written.')
-					pass
+	def to_json(self, device, mode="exclude", includeExcludeStates=frozenset()):
+		names = frozenset(includeExcludeStates)
+		newjson = {}
+		if self.wanted(u'name', mode, names):
+			newjson[u'name'] = unicode(device.name)
+
+		for attr, key, numkey, stringonly in self.filtered_plan(device, mode, names):
+			try:
+				val, numval = self.smart_values(getattr(device, attr))
+			except AttributeError:
+				continue
+
+			# some things change types - define the original name as original type, key.num as numeric
+			if key is not None and val is not None:
+				if stringonly or val.__class__.__name__.startswith('k'):
+					val = unicode(val)
+				newjson[key] = val
+			if numkey is not None and numval is not None:
+				if numval.__class__.__name__.startswith('k'):
+					numval = unicode(numval)
+				newjson[numkey] = numval
+
+		states = device.states
+		statekeys = self.state_keys(mode, names)
+		for state in states:
+			keys = statekeys.get(state)
+			if keys is None:
+				keys = self.state_fields(state, mode, names)
+
+			if keys[0] is None and keys[1] is None:
+				continue
+
+			val, numval = self.smart_values(states[state])
+			if keys[0] is not None and val is not None:
+				newjson[keys[0]] = val
+			if keys[1] is not None and numval is not None:
+				newjson[keys[1]] = numval
+
+		newjson[u'measurement'] = self.measurement(device)
 
 		return newjson
 
-	def diff_to_json(self, device, mode = "include", includeExcludeStates = [], sendPulse = False):
+	# the last values sent for a device, for heartbeats, without reading and
+	# converting the device again.  None if nothing was sent yet.
+	def pulse_json(self, device):
+		localcache = self.cache.get(device.id)
+		if localcache is None or u'measurement' not in localcache:
+			return None
+
+		pulsejson = dict(localcache.iteritems())
+		pulsejson['name'] = device.name
+		pulsejson['id'] = float(device.id)
+		return pulsejson
+
+	def diff_to_json(self, device, mode = "include", includeExcludeStates = [], sendPulse = False, deadband = None):
 		# strip out matching values?
 		# find or create our cache dict
-		newjson = self.to_json(device)
+		includeExcludeStates = frozenset(includeExcludeStates)
+		started = time_.time()
+		newjson = self.to_json(device, mode, includeExcludeStates)
+		now = time_.time()
+		if self.metrics is not None:
+			self.metrics.record('extract', now - started)
 
-		localcache = {}
-		if device.name in self.cache.keys():
-			localcache = self.cache[device.name]
+		localcache = self.cache.get(device.id)
+		if localcache is None:
+			localcache = {}
 
 		diffjson = {}
+		suppressed = []
 		hasOneUpdate = False
 		for kk, vv in newjson.iteritems():
 
 			# Check if it's changed
-			if kk not in localcache or localcache[kk] != vv or sendPulse:
+			old = localcache.get(kk, MISSING)
+			if sendPulse or old != vv:
 
 				if (mode == "include" and kk in includeExcludeStates) or (mode == "exclude" and kk not in includeExcludeStates):
+					# not enough of a change to bother with; the cache keeps
+					# the value last sent so that small changes add up
+					if not sendPulse and deadband and old is not MISSING and deadband.suppress(device.id, kk, old, vv, now):
+						suppressed.append(kk)
+						continue
+
 					if not isinstance(vv, indigo.Dict) and not isinstance(vv, dict):
 						diffjson[kk] = vv
-#						indigo.server.log('Sending property: ' + kk + " to InfluxDB for device: " + device.name)
 
 						if self.debug:
-							indigo.server.log('Sending property: ' + kk + " to InfluxDB for device: " + device.name)
+							self.logger.debug(u'Sending property: %s to InfluxDB for device: %s', kk, device.name)
 						hasOneUpdate = True
 
 		if not hasOneUpdate:
 			if self.debug:
-				indigo.server.log("no changed values found for device: " + device.name)
+				self.logger.debug(u'no changed values found for device: %s', device.name)
 
+			if self.metrics is not None:
+				self.metrics.record('diff', time_.time() - now)
 			return None
 			
-		if not device.name in self.cache.keys():
-			self.cache[device.name] = {}
-		self.cache[device.name].update(newjson)
+		for kk in suppressed:
+			del newjson[kk]
+		self.cache.update(device.id, device.name, newjson)
+		if deadband:
+			deadband.sent(device.id, diffjson, now)
 
 		# always make sure these survive
 		diffjson['name'] = device.name
 		diffjson['id'] = float(device.id)
 		diffjson[u'measurement'] = newjson[u'measurement']
+		if self.metrics is not None:
+			self.metrics.record('diff', time_.time() - now)
 
 		if self.debug:
-			indigo.server.log(json.dumps(newjson, default=indigo_json_serial).encode('utf-8'))
-			indigo.server.log(u'diff:')
-			indigo.server.log(json.dumps(diffjson, default=indigo_json_serial).encode('utf-8'))
+			self.logger.debug(u'%s\ndiff:\n%s', plugin_log.lazy_json(newjson), plugin_log.lazy_json(diffjson))
 
 		return diffjson
 
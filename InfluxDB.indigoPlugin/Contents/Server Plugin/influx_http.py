@@ -0,0 +1,56 @@
+import gzip
+import StringIO
+import requests
+from requests.adapters import HTTPAdapter
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+DEFAULT_TIMEOUT = 30	# seconds
+
+class InfluxHTTPWriter(object):
+	'''
+	Post line protocol to the InfluxDB write endpoint over a pooled,
+	keep-alive session, gzipped when worthwhile. Errors are raised as the
+	same exceptions InfluxDBClient uses.
+	'''
+	def __init__(self, host, port, username, password, database, compress=True, timeout=DEFAULT_TIMEOUT):
+		self.url = 'http://%s:%s/write' % (host, int(port))
+		self.params = {'db': database}
+		self.compress = compress
+		self.timeout = timeout
+
+		self.session = requests.Session()
+		self.session.auth = (username, password)
+		self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+		self.requests = 0
+		self.bytesSent = 0
+		self.bytesEncoded = 0
+
+	# data is a utf-8 encoded body of newline separated lines
+	def write(self, data, precision=None, retentionPolicy=None):
+		headers = {'Content-Type': 'application/octet-stream'}
+		params = dict(self.params)
+		if precision is not None:
+			params['precision'] = precision
+		if retentionPolicy is not None:
+			params['rp'] = retentionPolicy
+
+		self.bytesEncoded += len(data)
+		if self.compress and len(data) > 512:
+			buf = StringIO.StringIO()
+			with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=5) as f:
+				f.write(data)
+			data = buf.getvalue()
+			headers['Content-Encoding'] = 'gzip'
+
+		response = self.session.post(self.url, params=params, data=data, headers=headers, timeout=self.timeout)
+		self.requests += 1
+		self.bytesSent += len(data)
+
+		if 500 <= response.status_code < 600:
+			raise InfluxDBServerError(response.content)
+		if response.status_code != 204:
+			raise InfluxDBClientError(response.content, response.status_code)
+
+	def close(self):
+		self.session.close()
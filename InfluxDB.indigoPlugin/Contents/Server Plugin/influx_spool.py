@@ -0,0 +1,221 @@
+import os
+import urllib
+import threading
+import time as time_
+import logging
+
+DEFAULT_SPOOL_SIZE = 100	# megabytes kept on disk while InfluxDB is unreachable
+DEFAULT_SPOOL_FSYNC = 1.0	# seconds between forced flushes to disk
+SEGMENT_SIZE = 4 * 1024 * 1024	# largest segment; smaller for small spools
+MIN_SPOOL_SIZE = 64 * 1024
+
+SPOOL_EVICT = 'evict'		# make room by deleting the oldest segment
+SPOOL_DROP = 'drop'			# refuse new points when full
+
+class WriteSpool(object):
+	'''
+	Append-only, segmented write-ahead log of line protocol used while
+	InfluxDB cannot be reached. Segments are replayed oldest first. Points
+	for a retention policy other than the default go to segments of their
+	own, named after the policy, and are replayed into it.
+	'''
+	def __init__(self, path, maxBytes=DEFAULT_SPOOL_SIZE * 1024 * 1024, policy=SPOOL_EVICT, fsyncInterval=DEFAULT_SPOOL_FSYNC):
+		self.logger = logging.getLogger("Plugin.spool")
+		self.path = path
+		self.maxBytes = max(MIN_SPOOL_SIZE, int(maxBytes))
+		# at least 8 segments, so that eviction only drops a slice of the backlog
+		self.segmentSize = min(SEGMENT_SIZE, self.maxBytes // 8)
+		self.policy = policy
+		self.fsyncInterval = float(fsyncInterval)
+
+		self.lock = threading.RLock()
+		# held for a whole replay, which writes outside self.lock
+		self.replaying = threading.Lock()
+		# retention policy -> (open file, segment name) being appended to
+		self.active = {}
+		self.lastSync = 0
+
+		self.spooled = 0
+		self.replayed = 0
+		self.evicted = 0
+		self.dropped = 0
+		self.replaySeconds = 0.0
+
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+
+		self.segments = sorted(name for name in os.listdir(self.path) if name.endswith('.lp'))
+		self.size = sum(os.path.getsize(os.path.join(self.path, name)) for name in self.segments)
+		if self.segments:
+			self.logger.info(u'Found %d bytes of unsent points in the spool' % self.size)
+
+	def pending(self):
+		with self.lock:
+			return len(self.segments) > 0
+
+	# append lines of line protocol (without trailing newlines) to the spool
+	def append(self, lines, retentionPolicy=None):
+		if not lines:
+			return 0
+
+		data = (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+		with self.lock:
+			while self.size + len(data) > self.maxBytes:
+				if self.policy != SPOOL_EVICT or not self.segments:
+					self.dropped += len(lines)
+					return 0
+
+				self._closeSegment(self.segments[0])
+				self._evict(self.segments[0])
+
+			active = self.active.get(retentionPolicy)
+			if active is None or active[0].tell() >= self.segmentSize:
+				active = self._rotate(retentionPolicy)
+
+			active[0].write(data)
+			self.size += len(data)
+			self.spooled += len(lines)
+
+			now = time_.time()
+			if now - self.lastSync >= self.fsyncInterval:
+				self._sync()
+				self.lastSync = now
+
+		return len(lines)
+
+	# hand the spooled lines to write(lines, retentionPolicy) in batches,
+	# oldest first.  write()
+	# raises if the server is still unreachable and replay stops there; a
+	# partly replayed segment is sent again next time, which is harmless as
+	# every spooled line carries its timestamp.
+	# The lock is only held to pick and remove segments, so appends and
+	# stats() don't wait on the server.
+	def replay(self, write, batchSize):
+		with self.replaying:
+			started = time_.time()
+			count = 0
+
+			try:
+				while True:
+					with self.lock:
+						if not self.segments:
+							break
+						name = self.segments[0]
+						# new points go to a segment of their own from here
+						self._closeSegment(name)
+						lines = self._read(name)
+
+					# keep timestamp order within the segment
+					lines.sort(key=_timestamp)
+					for start in range(0, len(lines), batchSize):
+						write(lines[start:start + batchSize], segment_policy(name))
+						count += min(batchSize, len(lines) - start)
+
+					with self.lock:
+						# unless it was evicted in the meantime
+						if name in self.segments:
+							self._remove(name)
+			finally:
+				elapsed = time_.time() - started
+				with self.lock:
+					self.replayed += count
+					self.replaySeconds += elapsed
+
+				if count:
+					self.logger.info(u'Replayed %d spooled points in %.1f seconds (%d points/s)' % (
+						count, elapsed, count / max(elapsed, 0.001)))
+
+		return count
+
+	def close(self):
+		with self.lock:
+			self._close()
+
+	def stats(self):
+		with self.lock:
+			return {
+				'bytes': self.size,
+				'segments': len(self.segments),
+				'spooled': self.spooled,
+				'replayed': self.replayed,
+				'evicted': self.evicted,
+				'dropped': self.dropped,
+				'replayRate': self.replayed / self.replaySeconds if self.replaySeconds else 0.0
+			}
+
+	def _rotate(self, retentionPolicy):
+		self._closePolicy(retentionPolicy)
+
+		# names sort in creation order
+		stamp = int(time_.time() * 1000000)
+		if self.segments and stamp <= int(self.segments[-1][:17]):
+			stamp = int(self.segments[-1][:17]) + 1
+		name = segment_name(stamp, retentionPolicy)
+
+		active = self.active[retentionPolicy] = (open(os.path.join(self.path, name), 'ab'), name)
+		self.segments.append(name)
+		return active
+
+	def _sync(self):
+		for f, name in self.active.itervalues():
+			f.flush()
+			os.fsync(f.fileno())
+
+	def _close(self):
+		self._sync()
+		for f, name in self.active.itervalues():
+			f.close()
+		self.active = {}
+
+	def _closePolicy(self, retentionPolicy):
+		active = self.active.pop(retentionPolicy, None)
+		if active is not None:
+			active[0].flush()
+			os.fsync(active[0].fileno())
+			active[0].close()
+
+	# stop appending to a segment that is about to go
+	def _closeSegment(self, name):
+		for retentionPolicy, (f, activeName) in self.active.items():
+			if activeName == name:
+				self._closePolicy(retentionPolicy)
+
+	def _read(self, name):
+		with open(os.path.join(self.path, name), 'rb') as f:
+			data = f.read()
+
+		lines = data.decode('utf-8', 'replace').split(u'\n')
+		# the last entry is either empty or a line torn by a crash
+		return [line for line in lines[:-1] if line]
+
+	def _evict(self, name):
+		lines = len(self._read(name))
+		self._remove(name)
+		self.evicted += lines
+		self.logger.warning(u'Spool is full, discarded %d of the oldest unsent points' % lines)
+
+	def _remove(self, name):
+		filename = os.path.join(self.path, name)
+		self.size -= os.path.getsize(filename)
+		os.remove(filename)
+		self.segments.remove(name)
+
+# "<stamp>.lp" for the default retention policy, "<stamp>.<policy>.lp"
+# for others
+def segment_name(stamp, retentionPolicy=None):
+	if retentionPolicy is None:
+		return '%017d.lp' % stamp
+	return '%017d.%s.lp' % (stamp, urllib.quote(retentionPolicy.encode('utf-8'), safe=''))
+
+def segment_policy(name):
+	policy = name[18:-3]
+	if not policy:
+		return None
+	return urllib.unquote(policy).decode('utf-8')
+
+def _timestamp(line):
+	try:
+		return int(line.rsplit(' ', 1)[1])
+	except (IndexError, ValueError):
+		return 0
@@ -0,0 +1,467 @@
+import re
+import json
+import fnmatch
+import logging
+import threading
+import time as time_
+import requests
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from influx_writer import InfluxWriter, DEFAULT_BATCH_SIZE, DEFAULT_BATCH_AGE, DEFAULT_QUEUE_SIZE
+from influx_spool import WriteSpool, DEFAULT_SPOOL_SIZE, DEFAULT_SPOOL_FSYNC, SPOOL_EVICT
+from influx_http import InfluxHTTPWriter, DEFAULT_TIMEOUT
+from line_protocol import LineEncoder
+from field_types import FieldTypeRegistry
+
+MAIN_TARGET = 'main'	# the server set up in the plugin config
+MAX_CONFLICT_ROUNDS = 3  # number of times a batch is sent again after field type conflicts
+CONNECT_WAIT = 60	# seconds writes wait for the first connection before spooling
+
+CONFLICT_PATTERN = re.compile(r'input field "(?P<field>[^"]+)" on measurement "(?P<measurement>[^"]+)" is type \w+, already exists as type (?P<existing>\w+)')
+TARGET_PATTERN = re.compile(r'^(?P<name>\w+)=(?:(?P<user>[^:@]*):(?P<password>[^@]*)@)?(?P<host>[^:/@]+)(?::(?P<port>\d+))?/(?P<database>\w+)$')
+
+# every field type conflict InfluxDB reported for a write
+def parse_conflicts(error):
+	try:
+		message = json.loads(error.content)['error']
+	except (ValueError, TypeError, KeyError):
+		message = unicode(error)
+
+	return [(match.group('measurement'), match.group('field'), match.group('existing'))
+		for match in CONFLICT_PATTERN.finditer(message)]
+
+# "name=[user:password@]host[:port]/database" items separated by commas, e.g.
+# "central=indigo:secret@influx.example.com:8086/indigo, energy=localhost/energy".
+# Without a user and password those of the main server are used.
+def parse_targets(text):
+	logger = logging.getLogger("Plugin.targets")
+	targets = []
+	for item in (text or "").replace(" ", "").split(","):
+		if not item:
+			continue
+		match = TARGET_PATTERN.match(item)
+		if match is None or match.group('name') == MAIN_TARGET:
+			logger.warning(u'Ignoring InfluxDB target "%s", expected name=[user:password@]host[:port]/database' % item)
+			continue
+		targets.append(match.groupdict())
+	return targets
+
+# "measurement=target[+target...]" items separated by commas, e.g.
+# "energy_*=energy, *=main+central".  Measurements may use * and ?
+# wildcards; the first matching rule wins.
+def parse_routes(text):
+	logger = logging.getLogger("Plugin.targets")
+	routes = []
+	for item in (text or "").replace(" ", "").split(","):
+		if not item:
+			continue
+		try:
+			pattern, names = item.split("=", 1)
+		except ValueError:
+			logger.warning(u'Ignoring route "%s", expected measurement=target[+target...]' % item)
+			continue
+		routes.append((pattern, [name for name in names.split("+") if name]))
+	return routes
+
+class Router(object):
+	'''
+	Which targets each measurement is written to. Measurements no route
+	matches go to every target.
+	'''
+	def __init__(self, targets, routes=()):
+		self.targets = list(targets)
+		byName = dict((target.name, target) for target in self.targets)
+
+		self.routes = []
+		for pattern, names in routes:
+			for name in names:
+				if name not in byName:
+					logging.getLogger("Plugin.targets").warning(u'Route "%s" names unknown target "%s"' % (pattern, name))
+			self.routes.append((pattern, [byName[name] for name in names if name in byName]))
+
+		# measurement -> targets
+		self.matches = {}
+
+	def route(self, measurement):
+		try:
+			return self.matches[measurement]
+		except KeyError:
+			targets = self.targets
+			for pattern, candidates in self.routes:
+				if fnmatch.fnmatchcase(measurement, pattern):
+					targets = candidates
+					break
+			self.matches[measurement] = targets
+			return targets
+
+class InfluxTarget(object):
+	'''
+	One InfluxDB server and database with its own connection, write queue,
+	spool and failure state, so that a slow or unreachable server does not
+	hold up the others. Points arrive already coerced and encoded, with their
+	line protocol line.
+
+	The field types are shared by every target, as points are encoded once.
+	Where this server holds a field as another type than another target
+	registered, the type is kept as an override of this target's own and
+	its points are coerced and encoded again before they are written.
+	'''
+	def __init__(self, name, host, port, user, password, database, fieldTypes, precision,
+			quarantine=None, metrics=None, compress=True, reset=False):
+		self.logger = logging.getLogger("Plugin.targets")
+		self.name = name
+		self.label = u'InfluxDB' if name == MAIN_TARGET else u'InfluxDB target "%s"' % name
+		self.host = host
+		self.port = port or '8086'
+		self.user = user
+		self.password = password
+		self.database = database
+		self.fieldTypes = fieldTypes
+		# (measurement, field) -> type, where this server differs
+		self.overrides = FieldTypeRegistry()
+		self.precision = precision
+		# called with [(point, failed fields)] for points that never fit
+		self.quarantine = quarantine
+		self.metrics = metrics
+		self.compress = compress
+		self.reset = reset
+
+		self.connection = None
+		self.http = None
+		self.connected = False
+		# set once the first connection attempt is over, successful or not
+		self.ready = threading.Event()
+		# held while an attempt is going, so there is never more than one
+		self.connecting = threading.Lock()
+		# set while stopping, so writes stop waiting for the first connection
+		self.stopping = threading.Event()
+		self.writer = None
+		self.spool = None
+		self.batchSize = DEFAULT_BATCH_SIZE
+		# for the rare batch that has to be encoded again
+		self.encoder = LineEncoder()
+
+	def connect(self, reconnecting=False):
+		if not reconnecting:
+			self.logger.info(u'Starting %s connection' % self.label)
+
+		self.connection = InfluxDBClient(
+			host=self.host,
+			port=int(self.port),
+			username=self.user,
+			password=self.password,
+			database=self.database,
+			timeout=DEFAULT_TIMEOUT)
+
+		# points go straight to the write endpoint as line protocol
+		if self.http is not None:
+			self.http.close()
+		self.http = InfluxHTTPWriter(self.host, self.port, self.user, self.password, self.database,
+			compress=self.compress)
+
+		if self.reset and not reconnecting:
+			try:
+				self.logger.info(u'dropping old')
+				self.connection.drop_database(self.database)
+				self.fieldTypes.clear()
+			except:
+				pass
+
+		try:
+			if not reconnecting:
+				self.logger.info(u'Connecting...')
+			self.connection.create_database(self.database)
+			self.connection.switch_database(self.database)
+			self.connection.create_retention_policy('two_year_policy', '730d', '1')
+			self.logger.info(u'%s connection succeeded' % self.label)
+			self.connected = True
+		except:
+			self.connected = False
+			if not reconnecting:
+				self.logger.info(u'%s connection failed, points will be spooled until it is back' % self.label)
+			return
+
+		# learn the field types already in the database, so points go out
+		# right the first time
+		try:
+			self.overrides.clear()
+			count = self.fieldTypes.seed(self.connection, self.registerType)
+			self.fieldTypes.save()
+			logging.getLogger("Plugin.connection").debug(u'Loaded %d field types from %s', count, self.label)
+		except Exception as e:
+			self.logger.warning(u'Unable to read the field types from %s: %s' % (self.label, unicode(e)))
+
+	# the type this server holds for a field, from its field keys or a
+	# conflict.  The main server always has its way in the shared types;
+	# others only where no other target set a different type.
+	def registerType(self, measurement, field, influxType):
+		current = self.fieldTypes.get(measurement, field)
+		owner = self.fieldTypes.owner(measurement, field)
+		if self.name == MAIN_TARGET or current in (None, influxType) or owner in (None, self.name):
+			if owner not in (None, self.name) and current != influxType:
+				self.logger.warning(u'%s holds %s "%s" as %s, InfluxDB target "%s" registered %s' % (
+					self.label, measurement, field, influxType, owner, current))
+			self.fieldTypes.set(measurement, field, influxType, self.name)
+			self.overrides.remove(measurement, field)
+			return
+
+		if self.overrides.get(measurement, field) != influxType:
+			self.logger.warning(u'%s holds %s "%s" as %s, %s registered %s; keeping %s for this target only' % (
+				self.label, measurement, field, influxType,
+				u'InfluxDB' if owner == MAIN_TARGET else u'InfluxDB target "%s"' % owner, current, influxType))
+			self.overrides.set(measurement, field, influxType)
+
+	# connect on a thread of its own, so that a slow or unreachable server
+	# does not hold up the plugin; until then points wait in the queue.
+	# Returns False if an attempt is already going.
+	def connectInBackground(self, reconnecting=False):
+		if not self.connecting.acquire(False):
+			return False
+
+		def run():
+			try:
+				self.connect(reconnecting)
+			except Exception as e:
+				if not reconnecting:
+					self.logger.warning(u'Failed to connect to %s: %s' % (self.label, unicode(e)))
+			finally:
+				self.connecting.release()
+				self.ready.set()
+
+		thread = threading.Thread(target=run, name='InfluxConnect-' + self.name)
+		thread.daemon = True
+		thread.start()
+		return True
+
+	def start(self, spoolPath, spoolSize=DEFAULT_SPOOL_SIZE, spoolPolicy=SPOOL_EVICT, spoolFsync=DEFAULT_SPOOL_FSYNC,
+			batchSize=DEFAULT_BATCH_SIZE, batchAge=DEFAULT_BATCH_AGE, queueSize=DEFAULT_QUEUE_SIZE):
+		self.stop()
+		self.stopping.clear()
+
+		try:
+			self.spool = WriteSpool(spoolPath,
+				maxBytes=int(spoolSize) * 1024 * 1024,
+				policy=spoolPolicy,
+				fsyncInterval=float(spoolFsync))
+		except (IOError, OSError) as e:
+			self.logger.warning(u'Unable to open the spool of %s, points will be lost while it is down: %s' % (self.label, unicode(e)))
+
+		self.batchSize = int(batchSize)
+		self.writer = InfluxWriter(self.writeBatch,
+			batchSize=self.batchSize,
+			batchAge=float(batchAge),
+			queueSize=int(queueSize),
+			idle=self.writerIdle)
+		self.writer.start()
+
+	# what is still queued is written, or spooled if the server isn't there
+	def stop(self):
+		self.stopping.set()
+		if self.writer is not None:
+			writer = self.writer
+			writer.stop()
+			self.writer = None
+			if writer.is_alive() and self.spool is not None:
+				# still in the middle of a write; it spools what it can't
+				# send, so the spool is only closed once it is done
+				self.logger.warning(u'The %s writer is still busy, its spool is closed when it is done' % self.label)
+				closer = threading.Thread(target=self.closeSpool, args=(writer, self.spool), name='InfluxSpoolClose-' + self.name)
+				closer.daemon = True
+				closer.start()
+				return
+		if self.spool is not None:
+			self.spool.close()
+			self.spool = None
+
+	def closeSpool(self, writer, spool):
+		writer.join()
+		spool.close()
+
+	# never blocks, see InfluxWriter.put
+	def put(self, point, line):
+		writer = self.writer
+		if writer is None:
+			return False
+		return writer.put((point, line))
+
+	# a list of (point, line)
+	def putMany(self, items):
+		writer = self.writer
+		if writer is None:
+			return 0
+		return writer.putMany(items)
+
+	# called from the writer thread with a batch of (point, line)
+	def writeBatch(self, items):
+		# until the first connection attempt is over, unless stopping; then
+		# the batch is spooled
+		waited = 0
+		while not self.ready.is_set() and not self.stopping.is_set() and waited < CONNECT_WAIT:
+			self.ready.wait(0.5)
+			waited += 0.5
+
+		# rollups may go to a retention policy of their own
+		groups = {}
+		for item in items:
+			groups.setdefault(item[0].get('rp'), []).append(item)
+
+		for retentionPolicy, group in groups.iteritems():
+			self.writePoints(group, retentionPolicy)
+
+	def writePoints(self, items, retentionPolicy=None):
+		# keep the timeline in order: nothing new goes out before the backlog
+		if not self.connected or not self.replaySpool():
+			self.spoolPoints([point for point, line in items])
+			return
+
+		items = self.applyOverrides(items)
+		if not items:
+			return
+
+		# every point is stamped, so that sending a batch again after a
+		# partial write overwrites what did make it rather than duplicating it
+		data = (u'\n'.join(line for point, line in items) + u'\n').encode('utf-8')
+		points = None
+
+		# don't like my types? ok, fine, what DO you want?
+		for attempt in range(MAX_CONFLICT_ROUNDS + 1):
+			try:
+				started = time_.time()
+				self.http.write(data, self.precision, retentionPolicy)
+				if self.metrics is not None:
+					self.metrics.record('write', time_.time() - started)
+					self.metrics.count('points', len(items) if points is None else len(points))
+					self.metrics.count('bytes', len(data))
+				return
+			except InfluxDBClientError as e:
+				conflicts = parse_conflicts(e)
+				if not conflicts:
+					self.logger.warning(u'%s rejected a batch of %d points: %s' % (self.label, len(items), unicode(e)))
+					if self.metrics is not None:
+						self.metrics.count('rejected', len(items))
+					return
+
+				if self.metrics is not None:
+					self.metrics.count('retries')
+
+				# now we know to try to force these fields to these types forever more
+				for measurement, field, existing in conflicts:
+					self.registerType(measurement, field, existing)
+
+				if points is None:
+					# the points are shared with the other targets
+					points = [dict(point, fields=dict(point['fields'])) for point, line in items]
+
+				if attempt == MAX_CONFLICT_ROUNDS:
+					if self.quarantine is not None:
+						self.quarantine([(point, [field for measurement, field, existing in conflicts
+							if point['measurement'] == measurement and field in point['fields']]) for point in points])
+					return
+
+				points = self.coercePoints(points)
+				if not points:
+					return
+				data = self.encoder.encode_batch(points, self.precision)
+			except (requests.exceptions.RequestException, InfluxDBServerError) as e:
+				self.logger.warning(u'Lost the %s connection, spooling points until it is back: %s' % (self.label, unicode(e)))
+				self.connected = False
+				self.spoolPoints([point for point, line in items] if points is None else points)
+				return
+			except Exception as e:
+				self.logger.error(u'Error while trying to write to %s: %s' % (self.label, unicode(e)))
+				return
+
+	# points with fields this server holds as another type, coerced and
+	# encoded again for this server alone
+	def applyOverrides(self, items):
+		if not len(self.overrides):
+			return items
+
+		kept = []
+		rejected = []
+		for point, line in items:
+			if self.overrides.covers(point['measurement'], point['fields']):
+				# the point is shared with the other targets
+				point = dict(point, fields=dict(point['fields']))
+				failed = self.overrides.coerce(point['measurement'], point['fields'])
+				if failed:
+					rejected.append((point, failed))
+					continue
+				line = self.encoder.encode(point, self.precision)
+				if line is None:
+					continue
+			kept.append((point, line))
+
+		if rejected and self.quarantine is not None:
+			self.quarantine(rejected)
+		return kept
+
+	def coercePoints(self, points):
+		kept = []
+		rejected = []
+		for point in points:
+			failed = self.fieldTypes.coerce(point['measurement'], point['fields']) or \
+				self.overrides.coerce(point['measurement'], point['fields'])
+			if failed:
+				rejected.append((point, failed))
+			else:
+				kept.append(point)
+
+		if rejected and self.quarantine is not None:
+			self.quarantine(rejected)
+		return kept
+
+	def spoolPoints(self, points):
+		if self.spool is None:
+			return
+
+		# rollups keep their retention policy
+		groups = {}
+		for point in points:
+			groups.setdefault(point.get('rp'), []).append(point)
+
+		for retentionPolicy, group in groups.iteritems():
+			# spooled points keep full precision whatever the write precision is
+			lines = self.encoder.encode_lines(group, 'n')
+			self.spool.append(lines, retentionPolicy)
+			if self.metrics is not None:
+				self.metrics.count('spooled', len(lines))
+
+	# returns True once the spool is empty
+	def replaySpool(self):
+		if self.spool is None or not self.spool.pending():
+			return True
+
+		try:
+			self.spool.replay(self.writeLines, self.batchSize)
+		except (requests.exceptions.RequestException, InfluxDBServerError):
+			self.connected = False
+			return False
+		except InfluxDBClientError as e:
+			# e.g. not authorized or no such database: keep the backlog and
+			# try again after the next reconnect
+			self.logger.warning(u'%s refused the spooled points, keeping them: %s' % (self.label, unicode(e)))
+			self.connected = False
+			return False
+
+		return not self.spool.pending()
+
+	def writeLines(self, lines, retentionPolicy=None):
+		try:
+			self.http.write((u'\n'.join(lines) + u'\n').encode('utf-8'), None, retentionPolicy)
+		except InfluxDBClientError as e:
+			conflicts = parse_conflicts(e)
+			if not conflicts:
+				# anything else stops the replay, the segment stays
+				raise
+
+			# the rest of the batch was written; the server will never take
+			# these, don't hold everything else up
+			for measurement, field, existing in conflicts:
+				self.registerType(measurement, field, existing)
+			self.logger.warning(u'%s rejected some spooled points: %s' % (self.label, unicode(e)))
+
+	# called from the writer thread when there is nothing new to write
+	def writerIdle(self):
+		if self.connected:
+			self.replaySpool()
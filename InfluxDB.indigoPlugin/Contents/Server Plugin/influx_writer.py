@@ -0,0 +1,125 @@
+import threading
+import Queue
+import time as time_
+import logging
+
+DEFAULT_BATCH_SIZE = 5000	# max number of points per write
+DEFAULT_BATCH_AGE = 1.0		# max seconds a point waits before being written
+DEFAULT_QUEUE_SIZE = 100000	# max number of points waiting to be written
+
+class InfluxWriter(threading.Thread):
+	'''
+	Collect points from the Indigo callbacks in a bounded queue and write them
+	to InfluxDB in batches from a dedicated thread
+	'''
+	def __init__(self, write, batchSize=DEFAULT_BATCH_SIZE, batchAge=DEFAULT_BATCH_AGE, queueSize=DEFAULT_QUEUE_SIZE, idle=None):
+		super(InfluxWriter, self).__init__(name='InfluxWriter')
+		self.daemon = True
+		self.logger = logging.getLogger("Plugin.writer")
+
+		# called with a list of points, must not raise
+		self.write = write
+		# called from the writer thread whenever there is nothing to write
+		self.idle = idle
+		self.batchSize = max(1, int(batchSize))
+		self.batchAge = max(0.01, float(batchAge))
+		self.queue = Queue.Queue(maxsize=max(1, int(queueSize)))
+
+		self.running = False
+		self.lock = threading.Lock()
+		self.queued = 0
+		self.flushed = 0
+		self.dropped = 0
+		self.failed = 0
+		self.batches = 0
+
+	# never blocks the caller - if the queue is full the point is dropped
+	def put(self, point):
+		try:
+			self.queue.put_nowait(point)
+		except Queue.Full:
+			with self.lock:
+				self.dropped += 1
+			return False
+
+		with self.lock:
+			self.queued += 1
+		return True
+
+	# several points in one go, see put; returns how many were queued
+	def putMany(self, points):
+		queued = 0
+		for point in points:
+			try:
+				self.queue.put_nowait(point)
+			except Queue.Full:
+				break
+			queued += 1
+
+		with self.lock:
+			self.queued += queued
+			self.dropped += len(points) - queued
+		return queued
+
+	def start(self):
+		self.running = True
+		super(InfluxWriter, self).start()
+
+	def stop(self, timeout=10):
+		self.running = False
+		if self.is_alive():
+			self.join(timeout)
+
+	def run(self):
+		batch = []
+		oldest = None
+
+		while self.running or not self.queue.empty():
+			wait = self.batchAge
+			if oldest is not None:
+				wait = max(0, oldest + self.batchAge - time_.time())
+
+			try:
+				point = self.queue.get(True, wait)
+				if oldest is None:
+					oldest = time_.time()
+				batch.append(point)
+
+				# grab whatever else is already waiting without blocking
+				while len(batch) < self.batchSize:
+					batch.append(self.queue.get_nowait())
+			except Queue.Empty:
+				if not batch and self.idle is not None:
+					try:
+						self.idle()
+					except Exception as e:
+						self.logger.error(u'Error while idle: %s' % unicode(e))
+
+			if batch and (len(batch) >= self.batchSize or not self.running or time_.time() - oldest >= self.batchAge):
+				self.flush(batch)
+				batch = []
+				oldest = None
+
+	def flush(self, batch):
+		try:
+			self.write(batch)
+		except Exception as e:
+			self.logger.error(u'Error while writing a batch of %d points: %s' % (len(batch), unicode(e)))
+			with self.lock:
+				self.failed += len(batch)
+			return
+
+		with self.lock:
+			self.flushed += len(batch)
+			self.batches += 1
+
+	def stats(self):
+		with self.lock:
+			return {
+				'queued': self.queued,
+				'flushed': self.flushed,
+				'dropped': self.dropped,
+				'failed': self.failed,
+				'batches': self.batches,
+				'depth': self.queue.qsize()
+			}
@@ -0,0 +1,138 @@
+import math
+
+MAX_CACHED_TAG_SETS = 10000
+
+# write precision -> multiplier from epoch seconds
+PRECISIONS = {
+	'n': 1000000000,
+	'u': 1000000,
+	'ms': 1000,
+	's': 1
+}
+
+def escape_key(value):
+	if isinstance(value, str):
+		value = value.decode('utf-8')
+	elif not isinstance(value, unicode):
+		value = unicode(value)
+	return value.replace(u'\\', u'\\\\').replace(u' ', u'\\ ').replace(u',', u'\\,').replace(u'=', u'\\=').replace(u'\n', u'\\n')
+
+def _string(value):
+	if isinstance(value, str):
+		value = value.decode('utf-8')
+	return u'"' + value.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n') + u'"'
+
+def _float(value):
+	if math.isnan(value) or math.isinf(value):
+		return None
+	return repr(value)
+
+def _integer(value):
+	return str(value) + 'i'
+
+def _bool(value):
+	return 'True' if value else 'False'
+
+# value class -> field value formatter
+FORMATTERS = {
+	unicode: _string,
+	str: _string,
+	float: _float,
+	int: _integer,
+	long: _integer,
+	bool: _bool
+}
+
+def format_value(value):
+	formatter = FORMATTERS.get(value.__class__)
+	if formatter is not None:
+		return formatter(value)
+
+	if value is None:
+		return None
+	if isinstance(value, basestring):
+		return _string(value)
+	if isinstance(value, bool):
+		return _bool(value)
+	if isinstance(value, (int, long)):
+		return _integer(value)
+	try:
+		return _float(float(value))
+	except (TypeError, ValueError):
+		return unicode(value)
+
+class LineEncoder(object):
+	'''
+	Turn the plugin's point dicts into InfluxDB line protocol, without going
+	through the influxdb client. Point times are epoch seconds and are written
+	in the requested precision. The escaped measurement and tag set of each
+	device is kept, as it is the same for every point the device sends.
+	'''
+	def __init__(self):
+		# (measurement, tags) -> escaped "measurement,tag=value" prefix
+		self.prefixes = {}
+		# field name -> escaped field name
+		self.keys = {}
+
+	def prefix(self, measurement, tags, tagset=None):
+		# already escaped by the caller, see TagCache
+		if tagset is not None:
+			cachekey = (measurement, tagset)
+			prefix = self.prefixes.get(cachekey)
+			if prefix is None:
+				if len(self.prefixes) >= MAX_CACHED_TAG_SETS:
+					self.prefixes.clear()
+				prefix = self.prefixes[cachekey] = escape_key(measurement) + tagset
+			return prefix
+
+		cachekey = (measurement, tuple(sorted(tags.iteritems()))) if tags else (measurement, ())
+		prefix = self.prefixes.get(cachekey)
+		if prefix is None:
+			prefix = escape_key(measurement)
+			for key, value in cachekey[1]:
+				key = escape_key(key)
+				value = escape_key(value)
+				if key and value:
+					prefix += u',' + key + u'=' + value
+
+			if len(self.prefixes) >= MAX_CACHED_TAG_SETS:
+				self.prefixes.clear()
+			self.prefixes[cachekey] = prefix
+		return prefix
+
+	# one point as a line, or None if it has no fields InfluxDB would take
+	def encode(self, point, precision='n'):
+		keys = self.keys
+		fields = []
+		for key, value in sorted(point['fields'].iteritems()):
+			value = format_value(value)
+			if value is None:
+				continue
+
+			escaped = keys.get(key)
+			if escaped is None:
+				if len(keys) >= MAX_CACHED_TAG_SETS:
+					keys.clear()
+				escaped = keys[key] = escape_key(key)
+			if escaped:
+				fields.append(escaped + u'=' + value)
+
+		if not fields:
+			return None
+
+		line = self.prefix(point['measurement'], point.get('tags'), point.get('tagset')) + u' ' + u','.join(fields)
+		if point.get('time') is not None:
+			line += u' %d' % (point['time'] * PRECISIONS[precision])
+		return line
+
+	def encode_lines(self, points, precision='n'):
+		lines = []
+		for point in points:
+			line = self.encode(point, precision)
+			if line is not None:
+				lines.append(line)
+		return lines
+
+	# a batch of points as the body of a write request
+	def encode_batch(self, points, precision='n'):
+		return (u'\n'.join(self.encode_lines(points, precision)) + u'\n').encode('utf-8')
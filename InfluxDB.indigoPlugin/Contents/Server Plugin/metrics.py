@@ -0,0 +1,119 @@
+import math
+import threading
+import time as time_
+
+DEFAULT_METRICS_INTERVAL = 0	# seconds between internal metrics points, 0 for none
+INTERNAL_MEASUREMENT = u'indigo_influx_internal'
+BUCKETS = 25	# powers of two from 1 microsecond up to about 8 seconds
+
+class LatencyHistogram(object):
+	'''
+	Call times of one stage in power of two buckets of microseconds, cheap
+	enough to record on every call
+	'''
+	__slots__ = ('counts', 'count', 'total', 'max')
+
+	def __init__(self):
+		self.counts = [0] * BUCKETS
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, seconds):
+		# bucket n holds times of up to 2**n microseconds
+		bucket = math.frexp(seconds * 1000000)[1]
+		if bucket < 0:
+			bucket = 0
+		elif bucket >= BUCKETS:
+			bucket = BUCKETS - 1
+		self.counts[bucket] += 1
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	# upper bound of the bucket holding the given share of calls, in seconds
+	def percentile(self, share):
+		wanted = share * self.count
+		seen = 0
+		for bucket, count in enumerate(self.counts):
+			seen += count
+			if count and seen >= wanted:
+				return min(2 ** bucket / 1000000.0, self.max)
+		return self.max
+
+	def summary(self):
+		return {
+			'count': self.count,
+			'mean': self.total / self.count if self.count else 0.0,
+			'p50': self.percentile(0.5),
+			'p99': self.percentile(0.99),
+			'max': self.max
+		}
+
+class Metrics(object):
+	'''
+	Latency histograms per stage (extract, diff, encode, write...) and
+	counters (points, bytes, retries...) for the plugin's own statistics.
+	Both cover the time since the last reset, which is when the last
+	internal metrics point was written.
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		# stage -> LatencyHistogram
+		self.stages = {}
+		# name -> count since the plugin started
+		self.counters = {}
+		# counters at the last reset
+		self.base = {}
+		self.since = time_.time()
+
+	def record(self, stage, seconds):
+		with self.lock:
+			histogram = self.stages.get(stage)
+			if histogram is None:
+				histogram = self.stages[stage] = LatencyHistogram()
+			histogram.add(seconds)
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	# stage summaries, counters and their rates per second since the last
+	# reset; with reset the next snapshot starts from here
+	def snapshot(self, reset=False):
+		now = time_.time()
+		with self.lock:
+			elapsed = max(now - self.since, 0.001)
+			stages = dict((stage, histogram.summary()) for stage, histogram in self.stages.iteritems())
+			counters = dict(self.counters)
+			rates = dict((name, (value - self.base.get(name, 0)) / elapsed) for name, value in counters.iteritems())
+			since = self.since
+
+			if reset:
+				self.stages = {}
+				self.base = counters
+				self.since = now
+
+		return {
+			'since': since,
+			'elapsed': elapsed,
+			'stages': stages,
+			'counters': counters,
+			'rates': rates
+		}
+
+# a snapshot and gauges (queue depths, cache sizes) as the fields of one
+# internal metrics point, times in microseconds
+def to_fields(snapshot, gauges):
+	fields = {}
+	for stage, summary in snapshot['stages'].iteritems():
+		fields[stage + u'.count'] = float(summary['count'])
+		for key in ('mean', 'p50', 'p99', 'max'):
+			fields[stage + u'.' + key + u'_us'] = summary[key] * 1000000
+	for name, value in snapshot['counters'].iteritems():
+		fields[name] = float(value)
+		fields[name + u'.rate'] = snapshot['rates'][name]
+	for name, value in gauges.iteritems():
+		fields[name] = float(value)
+	return fields
@@ -15,29 +15,86 @@
 # GRANT ALL PRIVILEGES TO indigo
 #
 import indigo
+import os
+import threading
+import logging
 import time as time_
 import datetime
-import json
+import collections
 from indigo_adaptor import IndigoAdaptor
-from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBClientError
+from influx_writer import DEFAULT_BATCH_SIZE, DEFAULT_BATCH_AGE, DEFAULT_QUEUE_SIZE
+from influx_spool import DEFAULT_SPOOL_SIZE, DEFAULT_SPOOL_FSYNC, SPOOL_EVICT
+from influx_target import InfluxTarget, Router, MAIN_TARGET, CONNECT_WAIT, parse_targets, parse_routes
+from callback_pool import CallbackPool, DEFAULT_CALLBACK_WORKERS
+from coalesce import UpdateCoalescer, DEFAULT_COALESCE_WINDOW, DEFAULT_COALESCE_KEEP
+from field_types import FieldTypeRegistry
+from line_protocol import LineEncoder, PRECISIONS
+from heartbeat import HeartbeatScheduler, DEFAULT_PULSE_RATE
+from tag_cache import TagCache
+from variable_cache import VariableCache
+from deadband import Deadband, parse_rules
+from compression import SeriesCompressor
+import compression
+from rollup import RollupAggregator, DEFAULT_ROLLUP_WINDOW
+from metrics import Metrics, DEFAULT_METRICS_INTERVAL, INTERNAL_MEASUREMENT
+import metrics
+from profiler import SamplingProfiler, DEFAULT_PROFILE_SECONDS, DEFAULT_PROFILE_RATE
+import plugin_log
+from sql_backfill import SQLLoggerImporter, DEFAULT_CHUNK_SIZE, DEFAULT_BACKFILL_BATCH
+from query_cache import QueryRunner, result_value, DEFAULT_QUERY_TTL, DEFAULT_QUERY_SPACING
 from ghpu import GitHubPluginUpdater
+import benchmark
 
 DEFAULT_POLLING_INTERVAL = 60  # number of seconds between each poll
+HEARTBEAT_TICK = 1  # number of seconds between sending batches of heartbeats
+DEFAULT_PRECISION = 'ms'  # timestamp precision of writes
+ALWAYS_SENT = frozenset([u'name', u'id', u'measurement'])  # fields every device point carries
+QUARANTINE_SIZE = 1000  # number of rejected points kept for inspection
 
 class Plugin(indigo.PluginBase):
 	def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
 		super(Plugin, self).__init__(pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
+		self.started = time_.time()
 		indigo.devices.subscribeToChanges()
 		indigo.variables.subscribeToChanges()
-		self.connection = None
+		self.encoder = LineEncoder()
+		# every InfluxDB the points go to, and which measurements go where
+		self.targets = []
+		self.router = None
+		self.callbacks = None
+		self.coalescer = None
+		self.quarantine = collections.deque(maxlen=QUARANTINE_SIZE)
+		self.quarantined = 0
+		self.metrics = Metrics()
+		self.profiler = None
+		self.backfill = None
+		self.queries = None
+		self.metricsInterval = float(pluginPrefs.get("txtMetricsInterval", DEFAULT_METRICS_INTERVAL) or 0)
 		self.adaptor = IndigoAdaptor()
-		self.folders = {}
+		self.adaptor.metrics = self.metrics
+		self.variables = VariableCache(self.numericValue)
+		self.fieldTypes = FieldTypeRegistry(os.path.join(self.dataPath(), 'field_types.json'))
+		self.filters = {}
+		self.deadbandRules = parse_rules(pluginPrefs.get("txtDeadband", ""))
+		self.deadband = Deadband(self.deadbandRules)
+		self.deadbands = {}
+		self.compressor = SeriesCompressor(compression.parse_rules(pluginPrefs.get("txtCompression", "")))
+		self.configureRollups(pluginPrefs)
+		self.tags = TagCache(self.folderName, self.parseList(pluginPrefs.get("txtExtraTags", "")))
 		self.miniumumUpdateFrequency = int(pluginPrefs.get("txtMinimumUpdateFrequency", DEFAULT_POLLING_INTERVAL))
 		self.pollingInterval = 60
 
 		self.mode = pluginPrefs.get("ddlMode")
-		self.debug = pluginPrefs.get("debug", False)
+		self.precision = pluginPrefs.get("ddlPrecision", DEFAULT_PRECISION)
+		if self.precision not in PRECISIONS:
+			self.precision = DEFAULT_PRECISION
+		self.deviceLog = plugin_log.getLogger("devices")
+		self.heartbeatLog = plugin_log.getLogger("heartbeat")
+		self.connectionLog = plugin_log.getLogger("connection")
+		self.queryLog = plugin_log.getLogger("queries")
+		self.repeats = plugin_log.RepeatFilter()
+		self.indigo_log_handler.addFilter(self.repeats)
+		self.configureLogging(pluginPrefs)
 
 		try:
 			if self.mode == "include":
@@ -47,11 +104,50 @@ class Plugin(indigo.PluginBase):
 		except:
 			indigo.server.log(u'Problem parsing the inclusion / exclusion properties, check plugin config')
 
+		# checked from warmUp, GitHub can take a while to answer
 		self.updater = GitHubPluginUpdater(self)
-		self.updater.checkForUpdate(str(self.pluginVersion))
-		self.lastUpdateCheck = datetime.datetime.now()
-		self.varUpdateCheck = []
-		self.devUpdateCheck = []
+		self.lastUpdateCheck = None
+		# ('dev', id) / ('var', id) -> when the minimum update frequency runs out
+		self.heartbeats = HeartbeatScheduler(self.miniumumUpdateFrequency)
+		self.maxPulseRate = float(pluginPrefs.get("txtMaxPulseRate", DEFAULT_PULSE_RATE))
+
+	# a comma separated list from the plugin config
+	def parseList(self, value):
+		return [item for item in (value or "").replace(" ", "").split(",") if item]
+
+	# debug logging per subsystem; hot paths check self.debugging so that
+	# nothing is formatted while it is off
+	def configureLogging(self, prefs):
+		self.debug = prefs.get("debug", False)
+		self.debugging = plugin_log.configure(self.debug, self.parseList(prefs.get("txtDebugSubsystems", "")))
+		self.adaptor.debug = 'adaptor' in self.debugging
+		self.indigo_log_handler.setLevel(logging.DEBUG if self.debug else logging.INFO)
+
+	def configureRollups(self, prefs):
+		rollup = RollupAggregator(
+			window=int(prefs.get("txtRollupWindow", DEFAULT_ROLLUP_WINDOW) or DEFAULT_ROLLUP_WINDOW),
+			measurements=self.parseList(prefs.get("txtRollupMeasurements", "")),
+			fields=self.parseList(prefs.get("txtRollupFields", "*.num")) or ['*.num'],
+			retentionPolicy=prefs.get("txtRollupRetention", "").strip())
+
+		# windows that are still open carry on when nothing changed, so that
+		# saving the config doesn't write half windows
+		previous = getattr(self, 'rollup', None)
+		if previous is None or previous.settings() != rollup.settings():
+			self.flushRollups()
+			self.rollup = rollup
+		# measurements that are only written as rollups
+		self.rawOff = frozenset(self.parseList(prefs.get("txtRawOff", "")))
+
+	def folderName(self, folderId):
+		return indigo.devices.folders[folderId].name
+
+	# where the plugin keeps its own files
+	def dataPath(self):
+		path = os.path.join(indigo.server.getInstallFolderPath(), 'Preferences', 'Plugins', self.pluginId)
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		return path
 
 	def checkForUpdates(self):
 		self.updater.checkForUpdate()
@@ -59,208 +155,714 @@ class Plugin(indigo.PluginBase):
 	def updatePlugin(self):
 		self.updater.update()
 
-	def connect(self):
-		indigo.server.log(u'Starting influx connection')
+	# the main server from the plugin config and any extra targets, each
+	# connected and with its writer and spool running
+	def startTargets(self):
+		self.stopTargets()
+
+		prefs = self.pluginPrefs
+		specs = [{'name': MAIN_TARGET, 'host': self.host, 'port': self.port, 'user': self.user,
+			'password': self.password, 'database': self.database}] + parse_targets(prefs.get("txtTargets", ""))
+
+		targets = []
+		for spec in specs:
+			target = InfluxTarget(spec['name'], spec['host'], spec['port'],
+				spec['user'] if spec['user'] is not None else self.user,
+				spec['password'] if spec['password'] is not None else self.password,
+				spec['database'], self.fieldTypes, self.precision,
+				quarantine=self.quarantinePoints, metrics=self.metrics,
+				compress=prefs.get('gzip', True),
+				reset=spec['name'] == MAIN_TARGET and prefs.get('reset', False))
+
+			target.start(os.path.join(self.dataPath(), 'spool' if target.name == MAIN_TARGET else 'spool-' + target.name),
+				spoolSize=prefs.get("txtSpoolSize", DEFAULT_SPOOL_SIZE),
+				spoolPolicy=prefs.get("ddlSpoolPolicy", SPOOL_EVICT),
+				spoolFsync=prefs.get("txtSpoolFsync", DEFAULT_SPOOL_FSYNC),
+				batchSize=prefs.get("txtBatchSize", DEFAULT_BATCH_SIZE),
+				batchAge=prefs.get("txtBatchAge", DEFAULT_BATCH_AGE),
+				queueSize=prefs.get("txtQueueSize", DEFAULT_QUEUE_SIZE))
+			target.connectInBackground()
+			targets.append(target)
+
+		self.router = Router(targets, parse_routes(prefs.get("txtRoutes", "")))
+		self.targets = targets
+
+	def stopTargets(self):
+		targets = self.targets
+		self.targets = []
+		self.router = None
+		for target in targets:
+			target.stop()
+
+	# send this a dict of what to write, and when it happened (epoch seconds).
+	# tagset is the tags already escaped for line protocol, if known.
+	def send(self, tags, what, measurement='device_changes', when=None, tagset=None):
+		router = self.router
+		if router is None:
+			return
+
+		for point in self.rolledUp(self.makePoint(tags, what, measurement, when, tagset)):
+			self.route(router, point)
+
+	# several points made with makePoint, handed to each target in one go
+	def sendBatch(self, points):
+		router = self.router
+		if router is None:
+			return
 
-		self.connection = InfluxDBClient(
-			host=self.host,
-			port=int(self.port),
-			username=self.user,
-			password=self.password,
-			database=self.database)
+		batches = {}
+		for point in points:
+			for point in self.rolledUp(point):
+				line = self.encodePoint(point)
+				if line is not None:
+					for target in router.route(point['measurement']):
+						batches.setdefault(target, []).append((point, line))
+
+		for target, items in batches.iteritems():
+			target.putMany(items)
+
+	def makePoint(self, tags, what, measurement='device_changes', when=None, tagset=None):
+		point = {
+			'measurement': measurement,
+			'tags' : tags,
+			'fields':  what,
+			'time': time_.time() if when is None else when
+		}
+		if tagset is not None:
+			point['tagset'] = tagset
+		return point
+
+	# the rollups a point closes, and the point itself unless its
+	# measurement is only rolled up
+	def rolledUp(self, point):
+		if not self.rollup:
+			return (point,)
+
+		points = self.rollup.add(point['measurement'], point['tags'], point.get('tagset'), point['fields'], point['time'])
+		if point['measurement'] not in self.rawOff:
+			points.append(point)
+		return points
+
+	# write the samples every swinging door still holds back, while the
+	# targets are up, so the last line of each series stays within its
+	# deviation
+	def flushCompressor(self):
+		compressor = self.compressor
+		if not compressor:
+			return
 
-		if self.pluginPrefs.get('reset', False):
+		for id in compressor.devices():
 			try:
-				indigo.server.log(u'dropping old')
-				self.connection.drop_database(self.database)
-			except:
-				pass
+				dev = indigo.devices[id]
+			except KeyError:
+				compressor.forget(id)
+				continue
+			self.sendHeld(dev, compressor.flush(id), self.adaptor.measurement(dev))
+
+	# write every rollup window that is still open, while the targets are
+	# up; for measurements that are only rolled up it is all there is
+	def flushRollups(self):
+		rollup = getattr(self, 'rollup', None)
+		if not rollup:
+			return
 
-		try:
-			indigo.server.log(u'Connecting...')
-			self.connection.create_database(self.database)
-			self.connection.switch_database(self.database)
-			self.connection.create_retention_policy('two_year_policy', '730d', '1')
-			indigo.server.log(u'Influx connection succeeded')
-			self.connected = True
-		except:
-			self.connected = False
+		router = self.router
+		for point in rollup.flush():
+			if router is not None:
+				self.route(router, point)
+
+	# coerce and encode a point once, and queue it for every target its
+	# measurement goes to
+	def route(self, router, point):
+		line = self.encodePoint(point)
+		if line is None:
+			return
+
+		for target in router.route(point['measurement']):
+			target.put(point, line)
+
+	# the point as line protocol, or None if it has nothing to write
+	def encodePoint(self, point):
+		# bring every field in line with what the database already holds
+		failed = self.fieldTypes.coerce(point['measurement'], point['fields'])
+		if failed:
+			# the rest of the point still goes out, only the fields that
+			# don't fit are set aside
+			fields = point['fields']
+			held = dict((field, fields.pop(field)) for field in failed)
+			if ALWAYS_SENT.issuperset(fields):
+				fields.update(held)
+				self.quarantinePoints([(point, failed)])
+				return None
+
+			for field in ALWAYS_SENT.intersection(fields):
+				held[field] = fields[field]
+			self.quarantinePoints([(dict(point, fields=held), failed)])
+
+		started = time_.time()
+		line = self.encoder.encode(point, self.precision)
+		self.metrics.record('encode', time_.time() - started)
+		return line
+
+	def quarantinePoints(self, rejected):
+		summary = {}
+		count = 0
+		for point, fields in rejected:
+			if not fields:
+				continue
+			count += 1
+			self.quarantine.append(point)
+			for field in fields:
+				key = (point['measurement'], field)
+				summary[key] = summary.get(key, 0) + 1
+
+		if not count:
+			return
+
+		self.quarantined += count
+		# not formatted here, so that the same message over and over is
+		# held back by the repeat filter
+		self.logger.warning(u'Set aside fields of %d points that do not match the field types in InfluxDB: %s', count, u', '.join(
+			u'%s "%s" should be %s (%d)' % (measurement, field, self.fieldTypes.get(measurement, field), n)
+			for (measurement, field), n in sorted(summary.iteritems())))
+
+	def startCallbacks(self):
+		self.stopCallbacks()
+
+		workers = int(self.pluginPrefs.get("txtCallbackWorkers", DEFAULT_CALLBACK_WORKERS))
+		if workers > 0:
+			self.callbacks = CallbackPool(workers)
+			self.callbacks.start()
+
+	def stopCallbacks(self):
+		if self.callbacks is not None:
+			callbacks = self.callbacks
+			# anything that comes in while the queues drain is done inline
+			self.callbacks = None
+			callbacks.stop()
+
+	def startCoalescer(self):
+		self.stopCoalescer()
+
+		window = float(self.pluginPrefs.get("txtCoalesceWindow", DEFAULT_COALESCE_WINDOW) or 0)
+		if window > 0:
+			self.coalescer = UpdateCoalescer(self.coalescedUpdate, window / 1000.0,
+				self.parseList(self.pluginPrefs.get("txtCoalesceKeep", DEFAULT_COALESCE_KEEP)))
+			self.coalescer.start()
+
+	def stopCoalescer(self):
+		if self.coalescer is not None:
+			coalescer = self.coalescer
+			self.coalescer = None
+			coalescer.stop()
+
+	# an update that made it through the coalescing window
+	def coalescedUpdate(self, id, origDev, newDev, when):
+		self.dispatch(id, self.deviceChanged, origDev, newDev, when)
+
+	# run func on the worker for key, or right here without workers
+	def dispatch(self, key, func, *args):
+		callbacks = self.callbacks
+		if callbacks is None:
+			func(*args)
+		else:
+			callbacks.submit(key, func, *args)
 
-	# send this a dict of what to write
-	def send(self, tags, what, measurement='device_changes'):
-		if not self.connected:
+	def showWriterStats(self):
+		if not self.targets:
+			indigo.server.log(u'The InfluxDB writer is not running')
 			return
 
-		json_body=[
-			{
-				'measurement': measurement,
-				'tags' : tags,
-				'fields':  what
-			}
-		]
-
-#		if self.pluginPrefs.get(u'debug', False):
-#			indigo.server.log(json.dumps(json_body).encode('utf-8'))
-
-		# don't like my types? ok, fine, what DO you want?
-		retrylimit = 30
-		unsent = True
-		while unsent and retrylimit > 0:
-			retrylimit -= 1
+		for target in self.targets:
+			if target.writer is not None:
+				stats = target.writer.stats()
+				indigo.server.log(u'%s writer: %d points queued, %d flushed in %d batches, %d dropped, %d failed, %d waiting%s' % (
+					target.label, stats['queued'], stats['flushed'], stats['batches'], stats['dropped'], stats['failed'], stats['depth'],
+					u'' if target.connected else u', not connected'))
+
+			if target.http is not None:
+				indigo.server.log(u'%s writer: %d requests, %d KB of line protocol sent as %d KB' % (
+					target.label, target.http.requests, target.http.bytesEncoded / 1024, target.http.bytesSent / 1024))
+
+			if target.spool is not None:
+				stats = target.spool.stats()
+				indigo.server.log(u'%s spool: %d bytes in %d segments, %d points spooled, %d replayed at %d points/s, %d evicted, %d dropped' % (
+					target.label, stats['bytes'], stats['segments'], stats['spooled'], stats['replayed'], stats['replayRate'], stats['evicted'], stats['dropped']))
+
+		if self.callbacks is not None:
+			stats = self.callbacks.stats()
+			indigo.server.log(u'InfluxDB updates: %d handled by %d workers, %d dropped, %d failed, %d waiting' % (
+				stats['completed'], stats['workers'], stats['dropped'], stats['failed'], stats['depth']))
+
+		if self.coalescer is not None:
+			stats = self.coalescer.stats()
+			indigo.server.log(u'InfluxDB updates: %d device updates coalesced into %d, %d waiting' % (
+				stats['events'], stats['emitted'], stats['pending']))
+
+		if self.queries is not None:
+			stats = self.queries.stats()
+			indigo.server.log(u'InfluxDB queries: %d asked for, %d%% answered by the cache or a query already running (%d cached, %d merged), %d run, %d failed, %d dropped, %d waiting' % (
+				stats['asked'], stats['hitRate'] * 100, stats['hits'], stats['merged'], stats['queries'], stats['errors'], stats['dropped'], stats['depth']))
+
+		if self.rollup:
+			indigo.server.log(u'InfluxDB rollups: %d written, %d late samples left out, %d windows open' % (
+				self.rollup.emitted, self.rollup.late, len(self.rollup.windows)))
+
+		if self.quarantined:
+			indigo.server.log(u'InfluxDB writer: fields of %d points set aside for not matching the field types in InfluxDB' % self.quarantined)
+
+	# queue depths and cache sizes, for the metrics
+	def gauges(self):
+		gauges = {
+			'devices.cached': len(self.adaptor.cache),
+			'tags.cached': len(self.tags),
+			'variables.cached': len(self.variables),
+			'heartbeats': len(self.heartbeats),
+			'fieldTypes': len(self.fieldTypes),
+			'quarantined': self.quarantined
+		}
+		for target in self.targets:
+			if target.writer is not None:
+				gauges[target.name + '.depth'] = target.writer.stats()['depth']
+			if target.spool is not None:
+				gauges[target.name + '.spool.bytes'] = target.spool.stats()['bytes']
+		if self.callbacks is not None:
+			gauges['callbacks.depth'] = self.callbacks.stats()['depth']
+		if self.coalescer is not None:
+			gauges['coalescer.pending'] = self.coalescer.stats()['pending']
+		if self.queries is not None:
+			stats = self.queries.stats()
+			gauges['queries.cached'] = stats['cached']
+			gauges['queries.hitPercent'] = stats['hitRate'] * 100
+		return gauges
+
+	def showMetrics(self):
+		snapshot = self.metrics.snapshot()
+		indigo.server.log(u'Plugin metrics for the last %d seconds:' % snapshot['elapsed'])
+		for stage, summary in sorted(snapshot['stages'].iteritems()):
+			indigo.server.log(u'  %s: %d calls, mean %s, p50 %s, p99 %s, max %s' % (stage, summary['count'],
+				benchmark.format_time(summary['mean']), benchmark.format_time(summary['p50']),
+				benchmark.format_time(summary['p99']), benchmark.format_time(summary['max'])))
+		for name, value in sorted(snapshot['counters'].iteritems()):
+			indigo.server.log(u'  %s: %d (%.1f/s)' % (name, value, snapshot['rates'][name]))
+		for name, value in sorted(self.gauges().iteritems()):
+			indigo.server.log(u'  %s: %d' % (name, value))
+
+	# sample what every thread of the plugin is doing for a while, from the
+	# plugin menu; the collapsed stacks end up next to the plugin's log
+	def startProfiler(self, valuesDict, typeId):
+		if self.profiler is not None and self.profiler.is_alive():
+			indigo.server.log(u'The profiler is already running')
+			return True
+
+		try:
+			seconds = float(valuesDict.get("txtProfileSeconds", DEFAULT_PROFILE_SECONDS))
+			rate = float(valuesDict.get("txtProfileRate", DEFAULT_PROFILE_RATE))
+		except ValueError:
+			indigo.server.log(u'Profiling needs a number of seconds and samples per second')
+			return False
+
+		indigo.server.log(u'Profiling the plugin for %d seconds' % seconds)
+		self.profiler = SamplingProfiler(seconds, rate, done=self.profilerDone)
+		self.profiler.start()
+		return True
+
+	def profilerDone(self, profiler):
+		folder = os.path.join(indigo.server.getInstallFolderPath(), 'Logs', self.pluginId)
+		path = os.path.join(folder, 'profile-%s.collapsed' % datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+		try:
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+			profiler.write_collapsed(path)
+			indigo.server.log(u'Profile of %d samples over %d seconds written to %s' % (profiler.samples, profiler.elapsed, path))
+		except (IOError, OSError) as e:
+			indigo.server.log(u'Unable to write the profile: ' + unicode(e))
+
+		indigo.server.log(u'Top functions by share of a thread\'s time, cumulative / own:')
+		for name, cumulative, own in profiler.top():
+			indigo.server.log(u'  %6.1f%% %6.1f%%  %s' % (cumulative * 100, own * 100, name))
+
+	# import the history of Indigo's SQL Logger, from the plugin menu; runs
+	# in the background and picks up where it stopped when started again
+	def startBackfill(self, valuesDict, typeId):
+		if self.backfill is not None and self.backfill.is_alive():
+			indigo.server.log(u'SQL Logger import: ' + self.backfill.progress())
+			return True
+
+		path = valuesDict.get("txtBackfillPath", "").strip() or \
+			os.path.join(indigo.server.getInstallFolderPath(), 'Logs', 'indigo_history.sqlite')
+		if not os.path.exists(path):
+			indigo.server.log(u'No SQL Logger database at ' + path)
+			return False
+
+		try:
+			chunkSize = int(valuesDict.get("txtBackfillChunk", DEFAULT_CHUNK_SIZE))
+			batchSize = int(valuesDict.get("txtBackfillBatch", DEFAULT_BACKFILL_BATCH))
+		except ValueError:
+			indigo.server.log(u'The SQL Logger import needs numbers of rows and points')
+			return False
+
+		indigo.server.log(u'Importing the SQL Logger history from ' + path)
+		self.backfill = SQLLoggerImporter(path, self.adaptor, LineEncoder(), self.backfillContext, self.writeBackfill,
+			self.fieldTypes, os.path.join(self.dataPath(), 'backfill.json'), self.precision, chunkSize, batchSize)
+		self.backfill.start()
+		return True
+
+	def stopBackfill(self):
+		if self.backfill is not None and self.backfill.is_alive():
+			self.backfill.stop()
+		else:
+			indigo.server.log(u'No SQL Logger import is running')
+
+	# what the importer needs to know about a device or variable, the same
+	# as live updates use
+	def backfillContext(self, kind, id):
+		if kind == 'device':
 			try:
-				self.connection.write_points(json_body)
-				unsent = False
-			except InfluxDBClientError as e:
-				#print(str(e))
-				field = json.loads(e.content)['error'].split('"')[1]
-				#measurement = json.loads(e.content)['error'].split('"')[3]
-				retry = json.loads(e.content)['error'].split('"')[4].split()[7]
-				if retry == 'integer':
-					retry = 'int'
-				if retry == 'string':
-					retry = 'str'
-				# float is already float
-				# now we know to try to force this field to this type forever more
-				self.adaptor.typecache[field] = retry
+				dev = indigo.devices[id]
+			except KeyError:
+				return None
+
+			mode, names = self.deviceFilter(dev)
+			if mode is None:
+				return None
+			tags, tagset = self.tags.get(dev)
+			return {'name': dev.name, 'id': dev.id, 'measurement': self.adaptor.measurement(dev),
+				'mode': mode, 'names': names, 'states': dict(dev.states), 'tags': tags, 'tagset': tagset}
+
+		try:
+			var = indigo.variables[id]
+		except KeyError:
+			return None
+		return {'name': var.name, 'id': var.id, 'measurement': u'variable_changes',
+			'tags': {u'varname': var.name}, 'tagset': None}
+
+	# history goes to the main server only, in batches far bigger than
+	# live updates, so it skips the write queues
+	def writeBackfill(self, data):
+		targets = self.targets
+		if not targets or not targets[0].connected:
+			raise IOError(u'not connected to InfluxDB')
+		targets[0].http.write(data, self.precision)
+
+	def startQueries(self):
+		self.stopQueries()
+
+		self.queries = QueryRunner(self.runQuery,
+			float(self.pluginPrefs.get("txtQuerySpacing", DEFAULT_QUERY_SPACING) or 0), self.metrics)
+		self.queries.start()
+
+	def stopQueries(self):
+		if self.queries is not None:
+			self.queries.stop()
+			self.queries = None
+
+	# called from the query thread; queries go to the main server
+	def runQuery(self, query):
+		targets = self.targets
+		if not targets or not targets[0].connected:
+			raise IOError(u'not connected to InfluxDB')
+		# the raw series keeps the columns in the order of the query
+		series = targets[0].connection.query(query, epoch='s').raw.get('series')
+		return series[0] if series else None
+
+	def validateActionConfigUi(self, valuesDict, typeId, actionId):
+		errors = indigo.Dict()
+		if actionId == "queryToVariable":
+			valid, message = self.substitute(valuesDict.get("txtQuery", ""), validateOnly=True)
+			if not valuesDict.get("txtQuery", "").strip():
+				errors["txtQuery"] = u'Enter an InfluxQL query'
+			elif not valid:
+				errors["txtQuery"] = message
+
+			for field, kind in (("txtCacheSeconds", float), ("txtDecimals", int)):
 				try:
-					newcode = '%s("%s")' % (retry, str(json_body[0]['fields'][field]))
-					#indigo.server.log(newcode)
-					json_body[0]['fields'][field] = eval(newcode)
+					if valuesDict.get(field, "").strip():
+						kind(valuesDict[field])
 				except ValueError:
-					pass
-					#indigo.server.log('One of the columns just will not convert to its previous type. This means the database columns are just plain wrong.')
-			except ValueError:
-				if self.pluginPrefs.get(u'debug', False):
-					indigo.server.log(u'Unable to force a field to the type in Influx - a partial record was still written')
-			except Exception as e:
-				indigo.server.log("Error while trying to write:")
-				indigo.server.log(unicode(e))
-		if retrylimit == 0 and unsent:
-			if self.pluginPrefs.get(u'debug', False):
-				indigo.server.log(u'Unable to force all fields to the types in Influx - a partial record was still written')
+					errors[field] = u'Enter a number'
+
+			if not valuesDict.get("ddlVariable"):
+				errors["ddlVariable"] = u'Choose a variable'
+
+		if errors:
+			return (False, valuesDict, errors)
+		return (True, valuesDict)
+
+	# run an InfluxQL query and put the result in a variable.  %%v:id%% and
+	# %%d:id:state%% in the query are replaced by Indigo values first.
+	def queryToVariable(self, action):
+		if self.queries is None:
+			return
+
+		props = action.props
+		query = self.substitute(props.get("txtQuery", ""))
+		ttl = float(props.get("txtCacheSeconds", "") or DEFAULT_QUERY_TTL)
+		if not self.queries.submit(query, ttl, self.queryDone, int(props["ddlVariable"]),
+				props.get("txtColumn", "").strip(), props.get("txtDecimals", "").strip()):
+			self.queryLog.warning(u'Too many InfluxDB queries waiting, skipped %s' % query)
+
+	def queryDone(self, query, series, error, variableId, column, decimals):
+		if error is not None:
+			self.queryLog.warning(u'InfluxDB query failed: %s: %s' % (unicode(error), query))
+			return
+
+		value = result_value(series, column)
+		if value is None:
+			self.queryLog.info(u'InfluxDB query returned no value%s: %s' % (u' for ' + column if column else u'', query))
+			return
+
+		if decimals and isinstance(value, (int, long, float)) and not isinstance(value, bool):
+			value = u'%.*f' % (int(decimals), value)
+		else:
+			value = unicode(value)
+
+		try:
+			var = indigo.variables[variableId]
+		except KeyError:
+			self.queryLog.warning(u'Variable %d for the result of %s no longer exists' % (variableId, query))
+			return
+
+		# don't wake up triggers for nothing
+		if var.value != value:
+			indigo.variable.updateValue(variableId, value=value)
+
+	# write the plugin's own metrics as a point, so it can be graphed
+	def sendMetrics(self):
+		fields = metrics.to_fields(self.metrics.snapshot(reset=True), self.gauges())
+		if fields:
+			self.send(tags={}, what=fields, measurement=INTERNAL_MEASUREMENT)
 
 	def runConcurrentThread(self):
 		self.logger.debug("Starting concurrent tread")
 
-		self.sleep(int(self.pollingInterval))
+		lastPoll = time_.time()
+		lastMetrics = time_.time()
 
 		try:
 			# Polling - As far as what is known, there is no subscription method using web standards available from August.
 			while True:
-				try:
-					if self.connected:
-						self.updateAll()
+				self.sleep(HEARTBEAT_TICK)
 
+				# heartbeats go out a few at a time, every tick
+				try:
+					self.updateAll()
 				except:
 					pass
 
-				self.sleep(int(self.pollingInterval))
-
-		except self.StopThread:
-			self.logger.debug("Received StopThread")
-
-	def updateAll(self):
-		if self.debug:
-			self.logger.debug("running Update All")
+				router = self.router
+				if self.rollup and router is not None:
+					for point in self.rollup.expired(time_.time()):
+						self.route(router, point)
 
-		for dev in indigo.devices:
-			needsUpdating = False
-			found = False
+				if self.metricsInterval > 0 and time_.time() - lastMetrics >= self.metricsInterval:
+					lastMetrics = time_.time()
+					try:
+						self.sendMetrics()
+					except Exception as e:
+						self.logger.error(u'Error while writing plugin metrics: %s' % unicode(e))
 
-			for devSearch in self.devUpdateCheck:
-				if devSearch[0] == dev.name:
-					found = True
+				if time_.time() - lastPoll < self.pollingInterval:
+					continue
+				lastPoll = time_.time()
 
-					if devSearch[1] + datetime.timedelta(seconds=self.miniumumUpdateFrequency) < datetime.datetime.now():
-						if self.debug:
-							indigo.server.log("minimum update frequency for device expired: " + dev.name)
+				try:
+					for target in self.targets:
+						# the first attempt is still going in the background;
+						# a server that is down or hangs must not hold up
+						# this thread, or the other targets
+						if not target.connected and target.ready.is_set():
+							target.connectInBackground(reconnecting=True)
 
-						needsUpdating = True
-						devSearch[1] = datetime.datetime.now()
+					self.fieldTypes.save()
+					self.tags.refreshFolders()
 
-					break
+				except:
+					pass
 
-			if not found:
-				self.devUpdateCheck.append([dev.name, dev.lastChanged])
+		except self.StopThread:
+			self.logger.debug("Received StopThread")
 
-			if needsUpdating:
-				self.influxDevice(dev, dev, True)
+	# start tracking the minimum update frequency of everything there is
+	def scheduleAll(self):
+		for dev in indigo.devices:
+			if ('dev', dev.id) not in self.heartbeats:
+				self.heartbeats.touch(('dev', dev.id), time_.mktime(dev.lastChanged.timetuple()))
 
 		for var in indigo.variables:
-			needsUpdating = False
-			found = False
-
-			for varSearch in self.varUpdateCheck:
-				if varSearch[0] == var.name:
-					found = True
+			if ('var', var.id) not in self.heartbeats:
+				self.heartbeats.touch(('var', var.id))
 
-					if varSearch[1] + datetime.timedelta(seconds=self.miniumumUpdateFrequency) < datetime.datetime.now():
-						if self.debug:
-							indigo.server.log("minimum update frequency for variable expired: " + var.name)
+	def updateAll(self):
+		self.heartbeatLog.debug(u'running Update All')
 
-						needsUpdating = True
-						varSearch[1] = datetime.datetime.now()
+		limit = max(1, int(self.maxPulseRate * HEARTBEAT_TICK))
+		variables = []
+		for kind, id in self.heartbeats.expired(limit=limit):
+			if kind == 'var':
+				# read when the batch is sent, see pulseVariables
+				variables.append(id)
+				continue
 
-					break
+			try:
+				dev = indigo.devices[id]
+			except KeyError:
+				# deleted while we weren't looking
+				self.heartbeats.remove((kind, id))
+				continue
+
+			if 'heartbeat' in self.debugging:
+				self.heartbeatLog.debug(u'minimum update frequency for device expired: %s', dev.name)
+
+			self.dispatch(id, self.influxPulse, dev)
+
+		# variables are cheap, they all go out as one batch
+		if variables:
+			self.dispatch('variables', self.pulseVariables, variables)
+
+		# changes held back by a deadband interval that has since passed
+		now = time_.time()
+		deadbands = [self.deadband] + [deadband for custom, deadband in self.deadbands.values()]
+		for deadband in deadbands:
+			for id in deadband.due(now):
+				try:
+					dev = indigo.devices[id]
+				except KeyError:
+					continue
+				self.dispatch(id, self.deviceChanged, dev, dev, now)
 
-			if not found:
-				self.varUpdateCheck.append([var.name, datetime.datetime.now()])
+	def startup(self):
+		self.fieldTypes.load()
 
-			if needsUpdating:
-				self.influxVariable(var)
+		self.host = self.pluginPrefs.get('host', 'localhost')
+		self.port = self.pluginPrefs.get('port', '8086')
+		self.user = self.pluginPrefs.get('user', 'indigo')
+		self.password = self.pluginPrefs.get('password', 'indigo')
+		self.database = self.pluginPrefs.get('database', 'indigo')
 
+		# points queue up from here on, while the targets connect
+		self.startTargets()
+		self.startCallbacks()
+		self.startCoalescer()
+		self.startQueries()
 
+		warmUp = threading.Thread(target=self.warmUp, name='InfluxWarmUp')
+		warmUp.daemon = True
+		warmUp.start()
 
+		indigo.server.log(u'Ready for updates %d ms after starting' % ((time_.time() - self.started) * 1000))
 
-	def startup(self):
+	# what used to hold up startup: the update check, the first look at every
+	# device and variable, and waiting for the InfluxDB connections
+	def warmUp(self):
 		try:
-			self.host = self.pluginPrefs.get('host', 'localhost')
-			self.port = self.pluginPrefs.get('port', '8086')
-			self.user = self.pluginPrefs.get('user', 'indigo')
-			self.password = self.pluginPrefs.get('password', 'indigo')
-			self.database = self.pluginPrefs.get('database', 'indigo')
+			self.updater.checkForUpdate(str(self.pluginVersion))
+			self.lastUpdateCheck = datetime.datetime.now()
+		except Exception as e:
+			indigo.server.log(u'Unable to check for updates: ' + unicode(e))
 
-			self.connect()
-		except:
-			indigo.server.log(u'Failed to connect in startup')
-			pass
+		self.scheduleAll()
 
-		self.updateAll()
+		targets = list(self.targets)
+		for target in targets:
+			target.ready.wait(CONNECT_WAIT)
+
+		connected = [target.name for target in targets if target.connected]
+		waiting = [target.name for target in targets if not target.connected]
+		indigo.server.log(u'Warm-up done %.1f seconds after starting: %d devices and variables scheduled, connected to %s%s' % (
+			time_.time() - self.started, len(self.heartbeats), u', '.join(connected) or u'nothing',
+			u', still trying ' + u', '.join(waiting) if waiting else u''))
 
 	# called after runConcurrentThread() exits
 	def shutdown(self):
-		pass
+		if self.profiler is not None:
+			self.profiler.stop()
+		if self.backfill is not None:
+			self.backfill.stop()
+		self.stopQueries()
+		self.stopCoalescer()
+		self.stopCallbacks()
+		# held samples may still go into rollups
+		self.flushCompressor()
+		self.flushRollups()
+		self.stopTargets()
+		self.fieldTypes.save()
 
 	def deviceUpdated(self, origDev, newDev):
+		# stamp the change when Indigo tells us about it, not when it is written
+		when = time_.time()
+
 		# call base implementation
 		indigo.PluginBase.deviceUpdated(self, origDev, newDev)
 
-		if self.debug:
-			indigo.server.log("An update for device " + origDev.name + " is being processed...")
+		# origDev and newDev are our own copies, so they can be looked at
+		# later on a worker while Indigo moves on to the next change
+		coalescer = self.coalescer
+		if coalescer is not None:
+			coalescer.add(newDev.id, origDev, newDev, when)
+		else:
+			self.dispatch(newDev.id, self.deviceChanged, origDev, newDev, when)
+
+	def deviceChanged(self, origDev, newDev, when):
+		if 'devices' in self.debugging:
+			self.deviceLog.debug(u'An update for device %s is being processed...', origDev.name)
 
-		device_was_updated = self.influxDevice(origDev, newDev, False)
+		started = time_.time()
+		device_was_updated = self.influxDevice(origDev, newDev, False, when)
+		self.metrics.record('update', time_.time() - started)
 
 		if not device_was_updated:
-			if self.debug:
-				indigo.server.log("An update for device " + origDev.name + " resulted in no properties updated...")
+			if 'devices' in self.debugging:
+				self.deviceLog.debug(u'An update for device %s resulted in no properties updated...', origDev.name)
 
 			return
 
-		found = False
-		for devSearch in self.devUpdateCheck:
-			if devSearch[0] == origDev.name:
-				found = True
+		self.heartbeats.touch(('dev', newDev.id))
 
-				devSearch[1] = datetime.datetime.now()
-				break
+	def deviceCreated(self, dev):
+		indigo.PluginBase.deviceCreated(self, dev)
 
-		if not found:
-			self.devUpdateCheck.append([origDev.name, datetime.datetime.now()])
+		self.heartbeats.touch(('dev', dev.id))
+
+	def deviceDeleted(self, dev):
+		indigo.PluginBase.deviceDeleted(self, dev)
+
+		self.heartbeats.remove(('dev', dev.id))
+		if self.coalescer is not None:
+			self.coalescer.discard(dev.id)
+		# after whatever is still queued for the device
+		self.dispatch(dev.id, self.forgetDevice, dev.id)
+
+	def forgetDevice(self, id):
+		self.filters.pop(id, None)
+		self.adaptor.forget(id)
+		self.tags.forget(id)
+		self.deadband.forget(id)
+		self.deadbands.pop(id, None)
+		self.compressor.forget(id)
 
 	def closedPrefsConfigUi(self, valuesDict, userCancelled):
 		if not userCancelled:
+			# no updates half way through the new settings
+			self.stopCoalescer()
+			self.stopCallbacks()
+
+			# what is still held back goes to the targets that are running,
+			# so it is encoded at their precision, before it changes
+			self.flushCompressor()
+			self.compressor = SeriesCompressor(compression.parse_rules(valuesDict.get("txtCompression", "")))
+			self.configureRollups(valuesDict)
+
 			self.miniumumUpdateFrequency = int(valuesDict["txtMinimumUpdateFrequency"])
+			self.heartbeats.interval = self.miniumumUpdateFrequency
+			self.maxPulseRate = float(valuesDict.get("txtMaxPulseRate", DEFAULT_PULSE_RATE))
+			self.metricsInterval = float(valuesDict.get("txtMetricsInterval", DEFAULT_METRICS_INTERVAL) or 0)
+			if self.queries is not None:
+				self.queries.spacing = float(valuesDict.get("txtQuerySpacing", DEFAULT_QUERY_SPACING) or 0)
 			self.mode = valuesDict["ddlMode"]
+			self.precision = valuesDict.get("ddlPrecision", DEFAULT_PRECISION)
+			if self.precision not in PRECISIONS:
+				self.precision = DEFAULT_PRECISION
 
 			try:
 				if self.mode == "include":
@@ -275,99 +877,260 @@ class Plugin(indigo.PluginBase):
 			self.user = valuesDict['user']
 			self.password = valuesDict['password']
 			self.database = valuesDict['database']
-			self.debug = valuesDict["debug"]
-
+			self.configureLogging(valuesDict)
+			self.adaptor.invalidate()
+			self.filters.clear()
+			self.deadbandRules = parse_rules(valuesDict.get("txtDeadband", ""))
+			self.deadband = Deadband(self.deadbandRules)
+			self.deadbands.clear()
+			self.tags = TagCache(self.folderName, self.parseList(valuesDict.get("txtExtraTags", "")))
+
+			self.startTargets()
+			self.startCallbacks()
+			self.startCoalescer()
+
+	# the include/exclude list for a device, compiled into a set once and
+	# only rebuilt when the device's influxIncStates/influxExclStates changes
+	def deviceFilter(self, dev):
+		prop = u'influxIncStates' if self.mode == "include" else u'influxExclStates'
+		custom = None
+		if "com.indigodomo.indigoserver" in dev.globalProps:
+			props = dev.globalProps["com.indigodomo.indigoserver"]
+			if prop in props:
+				custom = props[prop]
+
+		cached = self.filters.get(dev.id)
+		if cached is not None and cached[0] == custom:
+			return cached[1], cached[2]
 
-			self.connect()
+		if self.mode == "include":
+			includeExcludeStates = list(getattr(self, 'globalIncludeStates', []))
+		else:
+			includeExcludeStates = list(getattr(self, 'globalExcludeStates', []))
 
+		if custom is not None:
+			if 'devices' in self.debugging and self.mode == "include":
+				self.deviceLog.debug(u'Including custom device properties (%s) to the include states for device %s', custom, dev.name)
 
+			if "," in custom:
+				for item in custom.replace(" ", "").split(","):
+					includeExcludeStates.append(item)
+			else:
+				includeExcludeStates.append(custom)
 
-	def influxDevice(self, origDev, newDev, sendPulse):
-		includeExcludeStates = []
+			if 'devices' in self.debugging and self.mode == "include":
+				self.deviceLog.debug(u'Include list: %s', plugin_log.Lazy(u', '.join, includeExcludeStates))
 
-		if self.mode == "include":
-			includeExcludeStates = self.globalIncludeStates[:]
+		if self.mode == "include" and "all" in includeExcludeStates:
+			# send everything
+			mode, states = "exclude", frozenset()
+		elif self.mode == "exclude" and "all" in includeExcludeStates:
+			# send nothing
+			mode, states = None, None
 		else:
-			includeExcludeStates = self.globalExcludeStates[:]
+			mode, states = self.mode, frozenset(includeExcludeStates)
+
+		if cached is not None:
+			# the cached values were filtered with the old list
+			self.adaptor.forget(dev.id)
+		self.filters[dev.id] = (custom, mode, states)
+		return mode, states
+
+	# compare the influxdb client's encoding with the plugin's own, on the
+	# last values of every device
+	def benchmarkEncoder(self):
+		points = []
+		for dev in indigo.devices:
+			newjson = self.adaptor.pulse_json(dev)
+			if newjson is None:
+				continue
+			measurement = newjson.pop(u'measurement')
+			points.append({'measurement': measurement, 'tags': self.tags.get(dev)[0], 'fields': newjson, 'time': time_.time()})
+
+		if not points:
+			points = benchmark.sample_points()
+
+		indigo.server.log(u'Encoder benchmark: ' + benchmark.format_encoder_benchmark(benchmark.encoder_benchmark(points)))
+
+	def showCacheStats(self):
+		stats = self.adaptor.cache.stats()
+		indigo.server.log(u'Device cache: %d devices, %d fields in %d shared layouts, about %d KB' % (
+			stats['devices'], stats['fields'], stats['layouts'], stats['bytes'] / 1024))
+
+	# compare the cost of extracting only the configured fields against
+	# extracting every attribute and state, as diff_to_json used to
+	def benchmarkExtraction(self):
+		devices = []
+		for dev in indigo.devices:
+			mode, states = self.deviceFilter(dev)
+			if mode is not None:
+				devices.append((dev, mode, states))
 
-		if "com.indigodomo.indigoserver" in origDev.globalProps:
-			if "influxIncStates" in origDev.globalProps["com.indigodomo.indigoserver"] and self.mode == "include":
-				if self.debug:
-					indigo.server.log(u'Including custom device properties (' + origDev.globalProps["com.indigodomo.indigoserver"]["influxIncStates"] + ") to the include states for device " + newDev.name)
+		if not devices:
+			indigo.server.log(u'No devices to benchmark')
+			return
 
-				if "," in origDev.globalProps["com.indigodomo.indigoserver"]["influxIncStates"]:
-					for item in origDev.globalProps["com.indigodomo.indigoserver"]["influxIncStates"].replace(" ", "").split(","):
-						includeExcludeStates.append(item)
-				else:
-					includeExcludeStates.append(origDev.globalProps["com.indigodomo.indigoserver"]["influxIncStates"])
+		filtered = benchmark.per_call(self.adaptor.to_json, devices)
+		full = benchmark.per_call(self.adaptor.to_json, [(dev,) for dev, mode, states in devices])
 
-				if self.debug:
-					indigo.server.log("Include list: ")
-					for item in includeExcludeStates:
-						indigo.server.log(item)
+		indigo.server.log(u'Extraction benchmark over %d devices in %s mode: %s per update with the filter applied, %s per update extracting everything (%.1fx)' % (
+			len(devices), self.mode, benchmark.format_time(filtered), benchmark.format_time(full), full / max(filtered, 0.0000001)))
 
-			elif "influxExclStates" in origDev.globalProps["com.indigodomo.indigoserver"] and self.mode == "exclude":
-				if "," in origDev.globalProps["com.indigodomo.indigoserver"]["influxExclStates"]:
-					for item in origDev.globalProps["com.indigodomo.indigoserver"]["influxExclStates"].replace(" ", "").split(","):
-						includeExcludeStates.append(item)
-				else:
-					includeExcludeStates.append(origDev.globalProps["com.indigodomo.indigoserver"]["influxExclStates"])
+	# what debug logging of the adaptor costs per device update, with it
+	# off and on
+	def benchmarkLogging(self):
+		devices = []
+		for dev in indigo.devices:
+			mode, states = self.deviceFilter(dev)
+			if mode is not None:
+				devices.append((dev, mode, states, True))
 
-		# custom add to influx work
-		# tag by folder if present
-		tagnames = u'name folderId'.split()
+		if not devices:
+			indigo.server.log(u'No devices to benchmark')
+			return
 
-		if self.mode == "include" and "all" in includeExcludeStates:
-			if self.debug:
-				indigo.server.log("Sending all attributes to be sent for device " + newDev.name)
+		def setDebug(on):
+			self.adaptor.debug = on
+		try:
+			result = benchmark.logging_benchmark(self.adaptor.diff_to_json, devices, setDebug, ['Plugin.adaptor'])
+		finally:
+			self.configureLogging(self.pluginPrefs)
 
-			newjson = self.adaptor.diff_to_json(newDev, "exclude", [], sendPulse)
-		elif self.mode == "exclude" and "all" in includeExcludeStates:
-			if self.debug:
-				indigo.server.log("Sending NO attributes to be sent to InfluxDB for device " + newDev.name)
+		indigo.server.log(u'Debug logging benchmark over %d devices: %s' % (len(devices), benchmark.format_logging_benchmark(result)))
+
+	# the deadband rules for a device: its own influxDeadband property in
+	# front of the global rules, built once per property value
+	def deviceDeadband(self, dev):
+		custom = None
+		if "com.indigodomo.indigoserver" in dev.globalProps:
+			props = dev.globalProps["com.indigodomo.indigoserver"]
+			if u'influxDeadband' in props:
+				custom = props[u'influxDeadband']
+
+		if custom is None:
+			return self.deadband
+
+		cached = self.deadbands.get(dev.id)
+		if cached is None or cached[0] != custom:
+			cached = self.deadbands[dev.id] = (custom, Deadband(parse_rules(custom) + self.deadbandRules))
+		return cached[1]
+
+	def influxDevice(self, origDev, newDev, sendPulse, when=None):
+		mode, includeExcludeStates = self.deviceFilter(newDev)
+
+		if mode is None:
+			if 'devices' in self.debugging:
+				self.deviceLog.debug(u'Sending NO attributes to be sent to InfluxDB for device %s', newDev.name)
 
 			return False
-		else:
-			newjson = self.adaptor.diff_to_json(newDev, self.mode, includeExcludeStates, sendPulse)
+
+		newjson = self.adaptor.diff_to_json(newDev, mode, includeExcludeStates, sendPulse, self.deviceDeadband(newDev))
 
 		if newjson == None:
 			return False
 
-		newtags = {}
-		for tag in tagnames:
-			newtags[tag] = unicode(getattr(newDev, tag))
+		if self.compressor and not sendPulse:
+			if when is None:
+				when = time_.time()
+			newjson, earlier = self.compressor.apply(newDev.id, newjson, when)
+			self.sendHeld(newDev, earlier, newjson[u'measurement'])
 
-		# add a folder name tag
-		if hasattr(newDev, u'folderId') and newDev.folderId != 0:
-			newtags[u'folder'] = indigo.devices.folders[newDev.folderId].name
+			# everything that changed is being held back for now
+			if ALWAYS_SENT.issuperset(newjson):
+				return True
 
-		measurement = newjson[u'measurement']
-		del newjson[u'measurement']
-		self.send(tags=newtags, what=newjson, measurement=measurement)
+		self.sendDevice(newDev, newjson, when)
 
 		return True
 
+	# samples the swinging door held back, each at its own time
+	def sendHeld(self, dev, samples, measurement):
+		for t, fields in samples:
+			fields[u'name'] = dev.name
+			fields[u'id'] = float(dev.id)
+			fields[u'measurement'] = measurement
+			self.sendDevice(dev, fields, t)
+
+	# resend the last known values of a device
+	def influxPulse(self, dev):
+		mode, includeExcludeStates = self.deviceFilter(dev)
+		if mode is None:
+			return False
+
+		# the last values sent are not the current ones while a deadband
+		# interval holds a change back, so read the device again
+		newjson = None
+		if not self.deviceDeadband(dev).held(dev.id):
+			newjson = self.adaptor.pulse_json(dev)
+		if self.compressor and newjson is not None:
+			self.sendHeld(dev, self.compressor.flush(dev.id), newjson[u'measurement'])
+
+		if newjson is None:
+			return self.influxDevice(dev, dev, True)
+
+		self.sendDevice(dev, newjson)
+
+		return True
+
+	def sendDevice(self, dev, newjson, when=None):
+		# custom add to influx work
+		# tag by name and folder, cached until the device is renamed or moved
+		newtags, tagset = self.tags.get(dev)
+
+		measurement = newjson[u'measurement']
+		del newjson[u'measurement']
+		self.send(tags=newtags, what=newjson, measurement=measurement, when=when, tagset=tagset)
+
 	def variableUpdated(self, origVar, newVar):
+		when = time_.time()
+
 		indigo.PluginBase.variableUpdated(self, origVar, newVar)
 
-		found = False
-		for varSearch in self.varUpdateCheck:
-			if varSearch[0] == origVar.name:
-				found = True
+		self.dispatch(newVar.id, self.influxVariable, newVar, when)
+
+	def variableCreated(self, var):
+		indigo.PluginBase.variableCreated(self, var)
+
+		self.heartbeats.touch(('var', var.id))
+
+	def variableDeleted(self, var):
+		indigo.PluginBase.variableDeleted(self, var)
 
-				varSearch[1] = datetime.datetime.now()
-				break
+		self.heartbeats.remove(('var', var.id))
+		# after whatever is still queued for the variable
+		self.dispatch(var.id, self.variables.forget, var.id)
 
-		if not found:
-			self.varUpdateCheck.append([origVar.name, datetime.datetime.now()])
+	def numericValue(self, value):
+		return self.adaptor.smart_value(value, True)
 
-		self.influxVariable(newVar)
+	def influxVariable(self, var, when=None):
+		changed = self.variables.changed(var)
+		if changed is None:
+			# set to the value it already had
+			self.metrics.count('variables.unchanged')
+			return
+
+		newjson, newtags, tagset = changed
+		self.send(tags=newtags, what=newjson, measurement=u'variable_changes', when=when, tagset=tagset)
+		self.heartbeats.touch(('var', var.id))
+
+	# resend the current values of variables whose minimum update frequency
+	# ran out
+	def pulseVariables(self, ids):
+		points = []
+		for id in ids:
+			# the batch runs on a worker of its own, so an update for the
+			# variable may be handled before it; reading the variable now
+			# means a heartbeat never stamps an older value later than that
+			try:
+				var = indigo.variables[id]
+			except KeyError:
+				self.heartbeats.remove(('var', id))
+				continue
 
-	def influxVariable(self, var):
-		newtags = {u'varname': var.name}
-		newjson = {u'name': var.name, u'value': var.value }
-		numval = self.adaptor.smart_value(var.value, True)
-		if numval != None:
-			newjson[u'value.num'] = numval
+			if 'heartbeat' in self.debugging:
+				self.heartbeatLog.debug(u'minimum update frequency for variable expired: %s', var.name)
 
-		self.send(tags=newtags, what=newjson, measurement=u'variable_changes')
+			newjson, newtags, tagset = self.variables.current(var)
+			points.append(self.makePoint(newtags, newjson, u'variable_changes', tagset=tagset))
+		self.sendBatch(points)
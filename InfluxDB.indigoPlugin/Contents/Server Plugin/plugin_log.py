@@ -0,0 +1,93 @@
+import json
+import logging
+import threading
+import time as time_
+
+# parts of the plugin whose debug logging can be turned on on their own
+SUBSYSTEMS = ('devices', 'adaptor', 'heartbeat', 'connection')
+DEFAULT_REPEAT_PERIOD = 60	# seconds
+DEFAULT_REPEAT_BURST = 5	# identical messages let through per period
+MAX_TRACKED_MESSAGES = 1000
+
+def getLogger(subsystem):
+	return logging.getLogger("Plugin." + subsystem)
+
+# set the debug level of every subsystem; returns the subsystems that log
+# debug messages, so hot paths can check a set instead of a logger
+def configure(debug, subsystems=()):
+	subsystems = frozenset(subsystems)
+	enabled = set()
+	for subsystem in SUBSYSTEMS:
+		if debug and (not subsystems or subsystem in subsystems):
+			enabled.add(subsystem)
+			getLogger(subsystem).setLevel(logging.DEBUG)
+		else:
+			getLogger(subsystem).setLevel(logging.INFO)
+	return frozenset(enabled)
+
+class Lazy(object):
+	'''
+	A log argument that is only worked out if the message is written
+	'''
+	__slots__ = ('func', 'args')
+
+	def __init__(self, func, *args):
+		self.func = func
+		self.args = args
+
+	def __str__(self):
+		return str(self.func(*self.args))
+
+	def __unicode__(self):
+		value = self.func(*self.args)
+		return value.decode('utf-8') if isinstance(value, str) else unicode(value)
+
+# a dict as json, only serialized when the message is written
+def lazy_json(value):
+	return Lazy(json.dumps, value)
+
+class RepeatFilter(logging.Filter):
+	'''
+	Let through only the first few of the same message in a period. The
+	next one after the period says how many were held back. Messages are
+	compared before they are formatted.
+	'''
+	def __init__(self, period=DEFAULT_REPEAT_PERIOD, burst=DEFAULT_REPEAT_BURST):
+		logging.Filter.__init__(self)
+		self.period = period
+		self.burst = burst
+		self.lock = threading.Lock()
+		# (logger, message, args) -> [period start, count, suppressed]
+		self.seen = {}
+		self.suppressed = 0
+
+	def filter(self, record):
+		key = (record.name, record.msg, record.args)
+		try:
+			hash(key)
+		except TypeError:
+			key = (record.name, record.msg)
+
+		now = time_.time()
+		with self.lock:
+			entry = self.seen.get(key)
+			if entry is not None and now - entry[0] < self.period:
+				entry[1] += 1
+				if entry[1] <= self.burst:
+					return True
+				entry[2] += 1
+				self.suppressed += 1
+				return False
+
+			if len(self.seen) >= MAX_TRACKED_MESSAGES:
+				for old, (started, count, suppressed) in self.seen.items():
+					if now - started >= self.period:
+						del self.seen[old]
+				if len(self.seen) >= MAX_TRACKED_MESSAGES:
+					self.seen.clear()
+			self.seen[key] = [now, 1, 0]
+
+		if entry is not None and entry[2]:
+			record.msg = u'%s (%d more like this suppressed)' % (record.getMessage(), entry[2])
+			record.args = ()
+		return True
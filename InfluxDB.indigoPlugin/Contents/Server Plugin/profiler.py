@@ -0,0 +1,99 @@
+import os
+import sys
+import threading
+import logging
+import time as time_
+
+DEFAULT_PROFILE_SECONDS = 30
+DEFAULT_PROFILE_RATE = 100	# samples per second
+TOP_FUNCTIONS = 15	# functions logged when a profile is done
+
+# "file.py:function" for a frame
+def frame_name(frame):
+	code = frame.f_code
+	return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+class SamplingProfiler(threading.Thread):
+	'''
+	Look at the stacks of every thread in the plugin process a number of
+	times per second, for a while, and count what they were doing. Costs
+	next to nothing in between samples, so it can run on a live server.
+	'''
+	def __init__(self, seconds=DEFAULT_PROFILE_SECONDS, rate=DEFAULT_PROFILE_RATE, done=None):
+		super(SamplingProfiler, self).__init__(name='InfluxProfiler')
+		self.daemon = True
+		self.logger = logging.getLogger("Plugin.profiler")
+
+		self.seconds = max(1.0, float(seconds))
+		self.interval = 1.0 / max(1.0, min(1000.0, float(rate)))
+		# called with the profiler once it is done
+		self.done = done
+
+		self.running = False
+		# "thread;outer;...;inner" -> samples
+		self.stacks = {}
+		# function -> samples it was running in (own) / on the stack in (cumulative)
+		self.own = {}
+		self.cumulative = {}
+		self.samples = 0
+		self.elapsed = 0.0
+
+	def start(self):
+		self.running = True
+		super(SamplingProfiler, self).start()
+
+	def stop(self):
+		self.running = False
+
+	def run(self):
+		me = threading.current_thread().ident
+		started = time_.time()
+		try:
+			while self.running and time_.time() - started < self.seconds:
+				self.sample(me)
+				time_.sleep(self.interval)
+		except Exception as e:
+			self.logger.error(u'Error while profiling: %s' % unicode(e))
+
+		self.elapsed = time_.time() - started
+		self.running = False
+		if self.done is not None:
+			self.done(self)
+
+	def sample(self, me):
+		names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+		for ident, frame in sys._current_frames().items():
+			if ident == me:
+				continue
+
+			stack = []
+			while frame is not None:
+				stack.append(frame_name(frame))
+				frame = frame.f_back
+			if not stack:
+				continue
+			stack.reverse()
+
+			self.own[stack[-1]] = self.own.get(stack[-1], 0) + 1
+			for name in set(stack):
+				self.cumulative[name] = self.cumulative.get(name, 0) + 1
+
+			key = names.get(ident, str(ident)) + ';' + ';'.join(stack)
+			self.stacks[key] = self.stacks.get(key, 0) + 1
+		self.samples += 1
+
+	# collapsed stacks, one "thread;outer;...;inner count" line per stack,
+	# as flamegraph.pl and speedscope read them
+	def write_collapsed(self, path):
+		with open(path, 'w') as f:
+			for stack, count in sorted(self.stacks.iteritems()):
+				f.write('%s %d\n' % (stack, count))
+
+	# (function, cumulative share, own share), busiest first; idle waits
+	# count as well, so look for plugin functions
+	def top(self, limit=TOP_FUNCTIONS):
+		if not self.samples:
+			return []
+		samples = float(self.samples)
+		ranked = sorted(self.cumulative.iteritems(), key=lambda item: item[1], reverse=True)[:limit]
+		return [(name, count / samples, self.own.get(name, 0) / samples) for name, count in ranked]
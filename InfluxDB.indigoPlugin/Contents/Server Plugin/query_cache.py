@@ -0,0 +1,161 @@
+import logging
+import threading
+import collections
+import time as time_
+
+DEFAULT_QUERY_TTL = 60	# seconds a query result is reused
+DEFAULT_QUERY_SPACING = 0.5	# min seconds between queries sent to InfluxDB
+MAX_CACHED_QUERIES = 500
+MAX_WAITING_QUERIES = 1000
+
+# the value of a column in the first row of a series as InfluxDB returns it
+# ({'columns': [...], 'values': [[...], ...]}), or of the first column after
+# time when no column is given; None for an empty result, a missing column
+# or a null value
+def result_value(series, column=None):
+	if not series or not series.get('values'):
+		return None
+
+	columns = series['columns']
+	if column:
+		if column not in columns:
+			return None
+		index = columns.index(column)
+	else:
+		index = 1 if columns[0] == 'time' and len(columns) > 1 else 0
+	return series['values'][0][index]
+
+class QueryRunner(threading.Thread):
+	'''
+	Run InfluxQL queries for the plugin's actions one at a time, spaced out
+	so that a burst of triggers does not hammer the database. Results are
+	kept for as long as each caller is happy to reuse them, and a query
+	asked for again while it is waiting or running is answered by that one
+	request.
+	'''
+	def __init__(self, query, spacing=DEFAULT_QUERY_SPACING, metrics=None):
+		super(QueryRunner, self).__init__(name='InfluxQueries')
+		self.daemon = True
+		self.logger = logging.getLogger("Plugin.queries")
+
+		# called with the query, returns its first series; raises if it failed
+		self.query = query
+		self.spacing = float(spacing)
+		self.metrics = metrics
+
+		self.running = False
+		self.lock = threading.Condition()
+		# query -> (when it ran, series)
+		self.cache = {}
+		# query -> [(func, args)] waiting for it, queued or running
+		self.pending = {}
+		self.waiting = collections.deque()
+		self.last = 0
+
+		self.hits = 0
+		self.misses = 0
+		self.merged = 0
+		self.queries = 0
+		self.errors = 0
+		self.dropped = 0
+
+	# func is called with (query, series, error, *args) once there is an
+	# answer no older than ttl seconds; right here if it is in the cache,
+	# otherwise from the query thread
+	def submit(self, query, ttl, func, *args):
+		now = time_.time()
+		with self.lock:
+			entry = self.cache.get(query)
+			if entry is not None and now - entry[0] < ttl:
+				self.hits += 1
+				series = entry[1]
+			else:
+				waiters = self.pending.get(query)
+				if waiters is not None:
+					self.merged += 1
+					waiters.append((func, args))
+				elif len(self.waiting) >= MAX_WAITING_QUERIES:
+					self.dropped += 1
+					return False
+				else:
+					self.misses += 1
+					self.pending[query] = [(func, args)]
+					self.waiting.append(query)
+					self.lock.notify()
+				return True
+
+		func(query, series, None, *args)
+		return True
+
+	def start(self):
+		self.running = True
+		super(QueryRunner, self).start()
+
+	def stop(self, timeout=10):
+		with self.lock:
+			self.running = False
+			self.lock.notify()
+		if self.is_alive():
+			self.join(timeout)
+
+	def run(self):
+		while True:
+			with self.lock:
+				while self.running and not self.waiting:
+					self.lock.wait()
+				if not self.running:
+					return
+				query = self.waiting.popleft()
+
+			pause = self.last + self.spacing - time_.time()
+			if pause > 0:
+				time_.sleep(pause)
+
+			series = None
+			error = None
+			started = time_.time()
+			try:
+				series = self.query(query)
+			except Exception as e:
+				error = e
+			self.last = time_.time()
+			if self.metrics is not None:
+				self.metrics.record('query', self.last - started)
+
+			with self.lock:
+				self.queries += 1
+				if error is None:
+					if len(self.cache) >= MAX_CACHED_QUERIES:
+						self.evict()
+					self.cache[query] = (started, series)
+				else:
+					self.errors += 1
+				waiters = self.pending.pop(query, [])
+
+			for func, args in waiters:
+				try:
+					func(query, series, error, *args)
+				except Exception as e:
+					self.logger.error(u'Error while handling the result of %s: %s' % (query, unicode(e)))
+
+	# drop the older half of the cached results
+	def evict(self):
+		entries = sorted(self.cache.iteritems(), key=lambda item: item[1][0])
+		for query, entry in entries[:len(entries) // 2 + 1]:
+			del self.cache[query]
+
+	def stats(self):
+		with self.lock:
+			asked = self.hits + self.misses + self.merged
+			return {
+				'asked': asked,
+				'hits': self.hits,
+				'misses': self.misses,
+				'merged': self.merged,
+				'hitRate': (self.hits + self.merged) / float(asked) if asked else 0.0,
+				'queries': self.queries,
+				'errors': self.errors,
+				'dropped': self.dropped,
+				'cached': len(self.cache),
+				'depth': len(self.waiting)
+			}
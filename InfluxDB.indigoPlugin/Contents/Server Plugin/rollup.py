@@ -0,0 +1,159 @@
+import fnmatch
+import threading
+
+DEFAULT_ROLLUP_WINDOW = 60	# seconds
+ROLLUP_GRACE = 5	# seconds a window is kept open after it ends, for late samples
+
+# "_1m" for 60 seconds, "_1h" for 3600, "_90s" for 90
+def window_suffix(window):
+	if window % 3600 == 0:
+		return '_%dh' % (window / 3600)
+	if window % 60 == 0:
+		return '_%dm' % (window / 60)
+	return '_%ds' % window
+
+class Window(object):
+	'''
+	Running mean/min/max/last of the fields of one series for one window
+	'''
+	__slots__ = ('start', 'tags', 'tagset', 'fields')
+
+	def __init__(self, start, tags, tagset):
+		self.start = start
+		self.tags = tags
+		self.tagset = tagset
+		# field -> [count, sum, min, max, last]
+		self.fields = {}
+
+	def add(self, field, value):
+		stats = self.fields.get(field)
+		if stats is None:
+			self.fields[field] = [1, value, value, value, value]
+			return
+		stats[0] += 1
+		stats[1] += value
+		if value < stats[2]:
+			stats[2] = value
+		if value > stats[3]:
+			stats[3] = value
+		stats[4] = value
+
+class RollupAggregator(object):
+	'''
+	Aggregate numeric fields into fixed windows in the plugin and emit one
+	rollup point per series when each window closes, so dashboards can read
+	the rollups instead of aggregating raw samples on every query
+	'''
+	def __init__(self, window=DEFAULT_ROLLUP_WINDOW, measurements=(), fields=('*.num',), retentionPolicy=None, grace=ROLLUP_GRACE):
+		self.window = max(1, int(window))
+		self.suffix = window_suffix(self.window)
+		self.measurements = frozenset(measurements)
+		self.patterns = tuple(fields)
+		self.retentionPolicy = retentionPolicy or None
+		self.grace = grace
+		self.lock = threading.Lock()
+		# field -> aggregated or not
+		self.matches = {}
+		# (measurement, series) -> Window
+		self.windows = {}
+		# (measurement, series) -> start of the last window written; samples
+		# up to it come too late and are left out rather than written again
+		# as a rollup of their own over the one already written
+		self.written = {}
+		self.emitted = 0
+		self.late = 0
+
+	def __nonzero__(self):
+		return len(self.measurements) > 0
+
+	# what the aggregator was built from; one built the same way can carry on
+	# with the windows of this one
+	def settings(self):
+		return (self.window, self.measurements, self.patterns, self.retentionPolicy)
+
+	def aggregated(self, field):
+		try:
+			return self.matches[field]
+		except KeyError:
+			match = any(fnmatch.fnmatchcase(field, pattern) for pattern in self.patterns)
+			self.matches[field] = match
+			return match
+
+	# take the numeric fields of a point into its window; returns rollup
+	# points for a window of the same series that this point closed
+	def add(self, measurement, tags, tagset, fields, when):
+		if measurement not in self.measurements:
+			return []
+
+		closed = []
+		start = int(when // self.window) * self.window
+		series = (measurement, tagset if tagset is not None else tuple(sorted(tags.iteritems())))
+
+		with self.lock:
+			if start <= self.written.get(series, start - 1):
+				self.late += 1
+				return []
+
+			window = self.windows.get(series)
+			if window is not None and window.start != start:
+				if window.start < start:
+					closed.append(self.close(series, window))
+					window = None
+				else:
+					# late for a window that is already written
+					self.late += 1
+					return []
+
+			for field, value in fields.iteritems():
+				if not isinstance(value, float) or not self.aggregated(field):
+					continue
+				if window is None:
+					window = self.windows[series] = Window(start, tags, tagset)
+				window.add(field, value)
+
+		return closed
+
+	# rollup points for every window that ended more than the grace period ago
+	def expired(self, now):
+		closed = []
+		with self.lock:
+			for series, window in self.windows.items():
+				if window.start + self.window + self.grace <= now:
+					closed.append(self.close(series, window))
+		return closed
+
+	# rollup points for every window, ended or not, when the plugin stops or
+	# the rollups are set up again
+	def flush(self):
+		with self.lock:
+			closed = [self.close(series, window) for series, window in self.windows.items()]
+		return closed
+
+	# called with the lock held
+	def close(self, series, window):
+		del self.windows[series]
+		self.written[series] = window.start
+		return self.point(series[0], window)
+
+	def point(self, measurement, window):
+		fields = {}
+		for field, (count, total, low, high, last) in window.fields.iteritems():
+			fields[field + '.mean'] = total / count
+			fields[field + '.min'] = low
+			fields[field + '.max'] = high
+			fields[field + '.last'] = last
+			fields[field + '.count'] = float(count)
+
+		point = {
+			'measurement': measurement + self.suffix,
+			'tags': window.tags,
+			'fields': fields,
+			'time': window.start
+		}
+		if window.tagset is not None:
+			point['tagset'] = window.tagset
+		if self.retentionPolicy is not None:
+			point['rp'] = self.retentionPolicy
+
+		self.emitted += 1
+		return point
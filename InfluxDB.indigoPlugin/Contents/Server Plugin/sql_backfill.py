@@ -0,0 +1,285 @@
+import os
+import re
+import json
+import sqlite3
+import logging
+import threading
+import time as time_
+from influxdb.exceptions import InfluxDBClientError
+from influx_target import parse_conflicts, MAIN_TARGET
+
+DEFAULT_CHUNK_SIZE = 5000	# rows read from SQLite at a time
+DEFAULT_BACKFILL_BATCH = 50000	# points per write
+PROGRESS_INTERVAL = 10	# seconds between progress reports
+
+TABLE_PATTERN = re.compile(r'^(device|variable)_history_(\d+)$')
+DROPPED_PATTERN = re.compile(r'dropped=(\d+)')
+ALWAYS_SENT = frozenset([u'name', u'id'])
+
+# SQL Logger keeps local time as "YYYY-MM-DD HH:MM:SS[.ffffff]"; epoch seconds
+def parse_timestamp(value):
+	if isinstance(value, (int, long, float)):
+		return float(value)
+
+	seconds, _, fraction = unicode(value).partition(u'.')
+	when = time_.mktime(time_.strptime(seconds, '%Y-%m-%d %H:%M:%S'))
+	if fraction:
+		when += float(u'0.' + fraction)
+	return when
+
+class Checkpoint(object):
+	'''
+	How far each history table has been written, saved after every batch so
+	that an import picks up where it stopped
+	'''
+	def __init__(self, path):
+		self.path = path
+		# table -> last row id written
+		self.positions = {}
+		# tables written to the end
+		self.done = set()
+
+	def load(self):
+		if not os.path.exists(self.path):
+			return
+		with open(self.path, 'rb') as f:
+			data = json.load(f)
+		self.positions = data.get('positions', {})
+		self.done = set(data.get('done', []))
+
+	def save(self):
+		with open(self.path + '.tmp', 'wb') as f:
+			json.dump({'positions': self.positions, 'done': sorted(self.done)}, f)
+		os.rename(self.path + '.tmp', self.path)
+
+	def position(self, table):
+		return self.positions.get(table, 0)
+
+class SQLLoggerImporter(threading.Thread):
+	'''
+	Stream the device and variable history tables of Indigo's SQL Logger
+	SQLite database into InfluxDB with their original timestamps. Rows are
+	read a chunk at a time and turned into points with the plugin's own
+	conversion and field naming, only writing what changed from the row
+	before, as the plugin does for live updates.
+	'''
+	def __init__(self, path, adaptor, encoder, resolve, write, fieldTypes, checkpointPath,
+			precision='ms', chunkSize=DEFAULT_CHUNK_SIZE, batchSize=DEFAULT_BACKFILL_BATCH):
+		super(SQLLoggerImporter, self).__init__(name='InfluxBackfill')
+		self.daemon = True
+		self.logger = logging.getLogger("Plugin.backfill")
+
+		self.path = path
+		self.adaptor = adaptor
+		self.encoder = encoder
+		# called with ('device' or 'variable', id); returns a dict with name,
+		# id, measurement, tags, tagset and for devices mode, names and
+		# states, or None to skip the table
+		self.resolve = resolve
+		# called with a utf-8 body of line protocol, raises if not written
+		self.write = write
+		self.fieldTypes = fieldTypes
+		self.checkpoint = Checkpoint(checkpointPath)
+		self.precision = precision
+		self.chunkSize = max(1, int(chunkSize))
+		self.batchSize = max(1, int(batchSize))
+
+		self.running = False
+		self.lines = []
+		# checkpoint changes that take effect once the lines are written
+		self.positions = {}
+		self.finished = []
+
+		self.tables = 0
+		self.tablesDone = 0
+		self.table = None
+		self.rows = 0
+		self.points = 0
+		self.skipped = 0
+		self.started = None
+		self.lastReport = 0
+
+	def start(self):
+		self.running = True
+		super(SQLLoggerImporter, self).start()
+
+	def stop(self):
+		self.running = False
+
+	def run(self):
+		self.started = time_.time()
+		try:
+			self.checkpoint.load()
+			connection = sqlite3.connect(self.path)
+			try:
+				tables = self.history_tables(connection)
+				self.tables = len(tables)
+				for kind, id, table in tables:
+					if not self.running:
+						break
+					if table not in self.checkpoint.done:
+						self.import_table(connection, kind, id, table)
+					self.tablesDone += 1
+				self.flush()
+			finally:
+				connection.close()
+		except Exception as e:
+			self.logger.error(u'SQL Logger import stopped, it will resume from the last checkpoint: %s' % unicode(e))
+			self.running = False
+			return
+
+		if self.running:
+			self.logger.info(u'SQL Logger import done: %s' % self.progress())
+		else:
+			self.logger.info(u'SQL Logger import stopped, it will resume from the last checkpoint: %s' % self.progress())
+		self.running = False
+
+	def history_tables(self, connection):
+		tables = []
+		for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"):
+			match = TABLE_PATTERN.match(name)
+			if match is not None:
+				tables.append((match.group(1), int(match.group(2)), name))
+		tables.sort()
+		return tables
+
+	def import_table(self, connection, kind, id, table):
+		self.table = table
+		context = self.resolve(kind, id)
+		if context is None:
+			self.logger.info(u'Skipping %s, the %s is gone or not sent to InfluxDB' % (table, kind))
+			self.finished.append(table)
+			return
+
+		columns = [row[1] for row in connection.execute('PRAGMA table_info("%s")' % table)]
+		if 'id' not in columns or 'ts' not in columns:
+			self.logger.info(u'Skipping %s, it has no id and ts columns' % table)
+			self.finished.append(table)
+			return
+		fields = self.field_plan(kind, context, columns)
+		times = columns.index('ts')
+
+		cursor = connection.execute('SELECT %s FROM "%s" WHERE id > ? ORDER BY id' % (
+			u', '.join(u'"%s"' % column for column in columns), table), (self.checkpoint.position(table),))
+		previous = {}
+		while self.running:
+			rows = cursor.fetchmany(self.chunkSize)
+			if not rows:
+				self.finished.append(table)
+				break
+
+			for row in rows:
+				self.rows += 1
+				self.add_row(context, fields, row, row[times], previous)
+				self.positions[table] = row[0]
+				if len(self.lines) >= self.batchSize:
+					self.flush()
+
+			if time_.time() - self.lastReport >= PROGRESS_INTERVAL:
+				self.lastReport = time_.time()
+				self.logger.info(u'SQL Logger import: %s' % self.progress())
+
+	# (column index, field name, numeric field name, make bool) per column;
+	# the id column comes first
+	def field_plan(self, kind, context, columns):
+		columns.remove('id')
+		columns.insert(0, 'id')
+		plan = []
+		if kind == 'variable':
+			if 'value' in columns:
+				plan.append((columns.index('value'), u'value', u'value.num', False))
+			return plan
+
+		# columns are named after states, not always in the same case
+		states = dict((state.lower(), state) for state in context['states'])
+		for index, column in enumerate(columns):
+			if column in ('id', 'ts'):
+				continue
+			state = states.get(column.lower(), column)
+			key, numkey = self.adaptor.state_fields(state, context['mode'], context['names'])
+			if key is None and numkey is None:
+				continue
+			plan.append((index, key, numkey, isinstance(context['states'].get(state), bool)))
+		return plan
+
+	def add_row(self, context, plan, row, when, previous):
+		fields = {}
+		for index, key, numkey, makebool in plan:
+			value = row[index]
+			if value is None or previous.get(index) == value:
+				continue
+			previous[index] = value
+
+			if numkey == u'value.num':
+				# as influxVariable does, variable values are strings
+				val = unicode(value)
+				numval = self.adaptor.smart_value(val, True)
+			else:
+				val, numval = self.adaptor.smart_values(value)
+				if makebool and val is not None:
+					val = bool(val)
+			if key is not None and val is not None:
+				fields[key] = val
+			if numkey is not None and numval is not None:
+				fields[numkey] = numval
+
+		if not fields:
+			return
+
+		fields[u'name'] = context['name']
+		if 'states' in context:
+			fields[u'id'] = float(context['id'])
+
+		if self.fieldTypes is not None:
+			# as for live updates, only the fields that don't fit are left out
+			failed = self.fieldTypes.coerce(context['measurement'], fields)
+			for field in failed:
+				del fields[field]
+			self.skipped += len(failed)
+			if ALWAYS_SENT.issuperset(fields):
+				return
+
+		line = self.encoder.encode({
+			'measurement': context['measurement'],
+			'tags': context['tags'],
+			'tagset': context['tagset'],
+			'fields': fields,
+			'time': parse_timestamp(when)
+		}, self.precision)
+		if line is not None:
+			self.lines.append(line)
+
+	def flush(self):
+		if self.lines:
+			dropped = 0
+			try:
+				self.write((u'\n'.join(self.lines) + u'\n').encode('utf-8'))
+			except InfluxDBClientError as e:
+				conflicts = parse_conflicts(e)
+				if not conflicts:
+					raise
+
+				# the rest of the batch was written; take the types InfluxDB
+				# holds for the rows still to come and move past it
+				if self.fieldTypes is not None:
+					for measurement, field, existing in conflicts:
+						self.fieldTypes.set(measurement, field, existing, MAIN_TARGET)
+				match = DROPPED_PATTERN.search(unicode(e))
+				dropped = min(len(self.lines), max(len(conflicts), int(match.group(1)) if match else 0))
+				self.skipped += dropped
+				self.logger.warning(u'InfluxDB dropped %d points of the SQL Logger import for not matching the field types: %s' % (
+					dropped, unicode(e)))
+			self.points += len(self.lines) - dropped
+			self.lines = []
+
+		self.checkpoint.positions.update(self.positions)
+		self.checkpoint.done.update(self.finished)
+		self.positions = {}
+		self.finished = []
+		self.checkpoint.save()
+
+	def progress(self):
+		elapsed = max(time_.time() - (self.started or time_.time()), 0.001)
+		return u'%d of %d tables, %d rows read, %d points written (%d points/s), %d skipped for not matching the field types%s' % (
+			self.tablesDone, self.tables, self.rows, self.points, self.points / elapsed, self.skipped,
+			u', at ' + self.table if self.running and self.table else u'')
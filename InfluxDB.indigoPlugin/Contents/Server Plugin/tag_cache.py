@@ -0,0 +1,86 @@
+import threading
+from line_protocol import escape_key
+
+class TagCache(object):
+	'''
+	The tags of every device, plain and escaped for line protocol, keyed by
+	device id. An entry is rebuilt only when the device is renamed or moved
+	to another folder, or its folder is renamed.
+	'''
+	def __init__(self, folderName, extraTags=()):
+		# called with a folder id, returns its name
+		self.folderName = folderName
+		self.extraTags = tuple(extraTags)
+		self.lock = threading.Lock()
+		# id -> (name, folderId, tags, escaped tag set)
+		self.devices = {}
+		# folder id -> name
+		self.folders = {}
+
+	def get(self, dev):
+		entry = self.devices.get(dev.id)
+		if entry is None or entry[0] != dev.name or entry[1] != dev.folderId:
+			entry = self.build(dev)
+		return entry[2], entry[3]
+
+	def build(self, dev):
+		tags = {u'name': unicode(dev.name), u'folderId': unicode(dev.folderId)}
+
+		# add a folder name tag
+		if dev.folderId != 0:
+			folder = self.folders.get(dev.folderId)
+			if folder is None:
+				try:
+					folder = self.folders[dev.folderId] = self.folderName(dev.folderId)
+				except KeyError:
+					pass
+			if folder is not None:
+				tags[u'folder'] = folder
+
+		for tag in self.extraTags:
+			value = getattr(dev, tag, None)
+			if value is not None and unicode(value) != u'':
+				tags[tag] = unicode(value)
+
+		tagset = u''
+		for key, value in sorted(tags.iteritems()):
+			tagset += u',' + escape_key(key) + u'=' + escape_key(value)
+
+		entry = (dev.name, dev.folderId, tags, tagset)
+		with self.lock:
+			self.devices[dev.id] = entry
+		return entry
+
+	def forget(self, id):
+		with self.lock:
+			self.devices.pop(id, None)
+
+	# check the folder names we know about; devices in a renamed folder
+	# get their tags rebuilt
+	def refreshFolders(self):
+		renamed = set()
+		for folderId, name in self.folders.items():
+			try:
+				current = self.folderName(folderId)
+			except KeyError:
+				current = None
+			if current != name:
+				renamed.add(folderId)
+				if current is None:
+					del self.folders[folderId]
+				else:
+					self.folders[folderId] = current
+
+		if renamed:
+			with self.lock:
+				for id, entry in self.devices.items():
+					if entry[1] in renamed:
+						del self.devices[id]
+
+	def clear(self):
+		with self.lock:
+			self.devices.clear()
+			self.folders.clear()
+
+	def __len__(self):
+		return len(self.devices)
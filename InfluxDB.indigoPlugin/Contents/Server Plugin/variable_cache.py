@@ -0,0 +1,71 @@
+import threading
+from line_protocol import escape_key
+
+class VariableCache(object):
+	'''
+	The last name and value sent for every variable, keyed by variable id,
+	with its tags, escaped tag set and numeric value worked out once rather
+	than on every update. Setting a variable to the value it already has
+	sends nothing.
+	'''
+	def __init__(self, numeric):
+		# called with a variable value, returns it as a number or None
+		self.numeric = numeric
+		self.lock = threading.Lock()
+		# id -> (name, value, numeric value, tags, escaped tag set)
+		self.variables = {}
+
+	# (fields, tags, tag set) to send for a variable, or None when neither
+	# its name nor its value changed since it was last sent
+	def changed(self, var):
+		entry = self.variables.get(var.id)
+		if entry is not None and entry[0] == var.name and entry[1] == var.value:
+			return None
+		return self.point(self.update(var, entry))
+
+	# the same for a heartbeat, whether it changed or not.  A value that
+	# differs is left for its own update to send and remember.
+	def current(self, var):
+		entry = self.variables.get(var.id)
+		if entry is None or entry[0] != var.name or entry[1] != var.value:
+			entry = self.build(var, entry)
+		return self.point(entry)
+
+	def update(self, var, entry):
+		entry = self.build(var, entry)
+		with self.lock:
+			self.variables[var.id] = entry
+		return entry
+
+	def build(self, var, entry):
+		if entry is not None and entry[0] == var.name:
+			tags, tagset = entry[3], entry[4]
+		else:
+			tags = {u'varname': unicode(var.name)}
+			tagset = u',varname=' + escape_key(tags[u'varname'])
+
+		if entry is not None and entry[1] == var.value:
+			numval = entry[2]
+		else:
+			numval = self.numeric(var.value)
+
+		return (var.name, var.value, numval, tags, tagset)
+
+	# fresh fields every time, they are changed on the way to InfluxDB
+	def point(self, entry):
+		name, value, numval, tags, tagset = entry
+		fields = {u'name': name, u'value': value}
+		if numval is not None:
+			fields[u'value.num'] = numval
+		return fields, tags, tagset
+
+	def forget(self, id):
+		with self.lock:
+			self.variables.pop(id, None)
+
+	def clear(self):
+		with self.lock:
+			self.variables.clear()
+
+	def __len__(self):
+		return len(self.variables)